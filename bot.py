@@ -56,6 +56,16 @@ class DiscordBot(discord.Client):
     def run(self):
         super().run(self.token)
 
+    async def close(self):
+        if (hook_name := config_path(f"hooks.close", None)) is not None:
+            hook = get_module_element(hook_name)
+            check_coroutine(hook)
+            try:
+                await hook(self)
+            except Exception:
+                logging.exception('Error on close hook')
+        await super().close()
+
     def send_log(self, msg: str):
         if self.log_channel is not None:
             asyncio.create_task(self.log_channel.send(msg))
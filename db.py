@@ -15,6 +15,9 @@ __author__ = 'Mathtin'
 
 from util import * 
 import json
+import asyncio
+import sqlite3
+import threading
 import config
 
 log = logging.getLogger('database')
@@ -22,60 +25,233 @@ log = logging.getLogger('database')
 class DatabaseContext(object):
     """
     Basic database context implementation
+
+    Every change marks context for a write-behind flush done within
+    flush_delay seconds: only tables changed since last flush are
+    serialized (on a worker thread) and the file is replaced atomically.
+
+    In journal mode every change is appended to <path>.journal instead,
+    flush syncs it to disk. The journal is compacted into the snapshot
+    at <path> once it grows past journal_limit records.
     """
 
-    def __init__(self, name):
+    def __init__(self, name, defaults: dict = None):
         
         self.name = name
+        self.defaults = defaults or {}
         self.tables = {}
-        self.indexes = {}
-        self.path = config_path(f"db.{name}.path", None)
-
-        table_conf = config_path(f"db.{name}.tables", {})
-        index_conf = config_path(f"db.{name}.indexes", {})
+        self.path = self._config("path", None)
+        self.journaled = self._config("journal", False)
+        self.journal_limit = self._config("journal_limit", 1000)
+        self.journal = None
+        self.journal_size = 0
+        self.compaction = None
+        self.flush_delay = self._config("flush_delay", 0)
+        self.flush_handle = None
+        self.flush_lock = None
+        self.serialized = {}
+
+        table_conf = self._config("tables", {})
+        index_conf = self._config("indexes", {})
 
         for table in table_conf:
-            self.tables[table] = []
-
-            if table in index_conf:
-                self.indexes[table] = {}
-                for index_name in index_conf[table]:
-                    self.indexes[table][index_name] = {}
+            self.tables[table] = TableContext(table, index_conf.get(table, None))
+            if self.journaled:
+                self.tables[table].subscribe(self.__journal_event)
             else:
-                self.indexes[table] = None
+                self.tables[table].subscribe(self.__mark_dirty)
+        self.dirty = set(self.tables)
+
+    def _config(self, key: str, default):
+        """ Setting db.<name>.<key>, context defaults take precedence over default """
+        return config_path(f"db.{self.name}.{key}", self.defaults.get(key, default))
 
     def clear(self):
-        for table in self.tables:
-            self.tables[table] = []
-        for table in self.indexes:
-            if self.indexes[table] is None:
-                continue
-            for index_name in self.indexes[table]:
-                self.indexes[table][index_name] = {}
+        for table in self.tables.values():
+            table.clear()
 
     def table(self, name):
-        return TableContext(name, self.tables[name], self.indexes[name])
+        return self.tables[name]
 
     def build_index(self):
-        for table_name in self.indexes:
-            self.table(table_name).build_index()
+        for table in self.tables.values():
+            table.build_index()
+
+    def dump(self):
+        return {name: table.dump() for name, table in self.tables.items()}
 
     def save(self):
-        with open(self.path, "w") as f:
-            json.dump(self.tables, f)
+        if self.journaled and self.journal is not None:
+            self.journal.flush()
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop to flush later
+            write_file(self.path, self.__serialize(self.__collect_dirty()))
+            return
+        self.__schedule_flush()
+
+    def __schedule_flush(self):
+        if self.path is None or self.flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Left dirty until next save
+            return
+        self.flush_handle = loop.call_later(self.flush_delay, self.__flush_later)
+
+    async def flush(self):
+        """ Write pending changes on disk now """
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        loop = asyncio.get_running_loop()
+        if self.journaled and self.journal is not None:
+            self.journal.flush()
+            await loop.run_in_executor(None, os.fsync, self.journal.fileno())
+            return
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+        async with self.flush_lock:
+            if len(self.dirty) == 0:
+                return
+            data = self.__collect_dirty()
+            await loop.run_in_executor(None, lambda: write_file(self.path, self.__serialize(data)))
+
+    def __flush_later(self):
+        self.flush_handle = None
+        asyncio.ensure_future(self.flush())
+
+    def __mark_dirty(self, event: str, table, row: dict):
+        self.dirty.add(table.name)
+        if event != 'load':
+            self.__schedule_flush()
+
+    def __collect_dirty(self):
+        # Rows may change in place later, copies go to worker thread
+        data = {name: [dict(row) for row in self.tables[name]] for name in self.dirty}
+        self.dirty = set()
+        return data
+
+    def __serialize(self, data: dict):
+        for name, rows in data.items():
+            self.serialized[name] = json.dumps(rows)
+        entries = [f'{json.dumps(name)}: {self.serialized[name]}' for name in self.tables]
+        return '{' + ', '.join(entries) + '}'
 
     def load(self):
-        if not os.path.exists(self.path):
-            self.clear()
-            self.save()
+        # Compaction may still be writing snapshot and own old journal
+        self.wait_compaction()
+        data = {}
         try:
-            with open(self.path, "r") as f:
-                self.tables = json.load(f)
-                self.build_index()
+            if os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+            elif not self.journaled:
+                self.clear()
+                self.save()
+                return
         except json.decoder.JSONDecodeError:
-            log.error("Failed to load persist database, removing invalid data")
-            self.clear()
-            self.save()
+            # Keep broken file for manual recovery
+            os.replace(self.path, self.path + ".corrupt")
+            log.error(f"Failed to load {self.name} database, invalid data moved to {self.path}.corrupt")
+            if not self.journaled:
+                self.clear()
+                self.save()
+                return
+
+        for name, table in self.tables.items():
+            table.load(data.get(name, []))
+        self.dirty = set(self.tables)
+
+        if self.journaled:
+            self.__replay_journal()
+            self.build_index()
+
+        # Rows were replaced without add events
+        for table in self.tables.values():
+            table._notify('load')
+
+    #################
+    # Journal       #
+    #################
+
+    def __journal_path(self, old=False):
+        return self.path + (".journal.old" if old else ".journal")
+
+    def __replay_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+
+        # Old journal is left if compaction was interrupted
+        for path in [self.__journal_path(old=True), self.__journal_path()]:
+            if not os.path.exists(path):
+                continue
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        log.warn(f"Skipping broken journal record in {path}")
+                        continue
+                    if record[1] in self.tables:
+                        self.tables[record[1]].replay(record[0], record[2])
+
+        # Start over with fresh snapshot
+        write_json(self.path, self.dump())
+        self.journal = open(self.__journal_path(), "w")
+        self.journal_size = 0
+        if os.path.exists(self.__journal_path(old=True)):
+            os.remove(self.__journal_path(old=True))
+
+    def __journal_event(self, event: str, table, row: dict):
+        if self.journal is None or event == 'load':
+            return
+        # Replaying add over existing id updates row in place
+        if event in ('add', 'update'):
+            record = ['add', table.name, row]
+        elif event == 'remove':
+            record = [event, table.name, row['id']]
+        else:
+            record = [event, table.name, None]
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+        self.journal_size += 1
+        if self.journal_size >= self.journal_limit:
+            self.compact()
+        self.__schedule_flush()
+
+    def compact(self):
+        if self.compaction is not None and self.compaction.is_alive():
+            return
+        # Rows may change in place later, snapshot copies
+        data = {name: [dict(row) for row in rows] for name, rows in self.dump().items()}
+
+        # Records from now on go to new journal
+        self.journal.close()
+        os.replace(self.__journal_path(), self.__journal_path(old=True))
+        self.journal = open(self.__journal_path(), "w")
+        self.journal_size = 0
+
+        def write_snapshot():
+            write_json(self.path, data)
+            os.remove(self.__journal_path(old=True))
+
+        self.compaction = threading.Thread(target=write_snapshot, daemon=True)
+        self.compaction.start()
+
+    def wait_compaction(self):
+        if self.compaction is not None:
+            self.compaction.join()
+
+    def find(self, **predicates):
+        """ Rows of all tables matching predicates as (table, row) pairs, see TableContext.find """
+        result = []
+        for table in self.tables.values():
+            result += [(table, row) for row in table.find(**predicates)]
+        return result
 
     def __getitem__(self, table_name):
         if table_name not in self.tables:
@@ -83,113 +259,551 @@ class DatabaseContext(object):
         return self.table(table_name)
 
     def __getattr__(self, table_name):
-        if table_name not in self.tables:
+        if table_name == 'tables' or table_name not in self.tables:
             raise AttributeError(f'No such table "{table_name}"')
         return self.table(table_name)
 
     def __iter__(self):
-        return DatabaseContextIterator(self)
+        return iter(self.tables.values())
 
     def __contains__(self, table_name):
         return table_name in self.tables
 
-class DatabaseContextIterator(object):
+def write_file(path: str, content: str):
+    """ Crash-safe write: either old or new content is left on disk """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # Persist rename itself
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def write_json(path: str, data):
+    write_file(path, json.dumps(data))
+
+class UniqueConstraintError(Exception):
+
+    def __init__(self, table: str, index: str, value):
+        super().__init__(f'Duplicate value {value!r} for unique index "{index}" in table "{table}"')
+
+class TableIndex(object):
     """
-    Basic database context iterator implementation
+    Index maintained by table on each change
+
+    Declared in config.db as column name or dict with keys:
+        column/columns - indexed column or list of columns (composite, tuple key)
+        name           - attribute name, defaults to columns joined by "_"
+        unique         - value maps to single row, duplicates are rejected
+        casefold       - string values are compared case-insensitively
+    Non-unique index maps value to list of rows.
     """
-    def __init__(self, db):
-       self._db = db
-       self._iter = db.tables.__iter__()
-   
-    def __next__(self):
-        table_name = self._iter.__next__()
-        return self._db.table(table_name)
+
+    def __init__(self, table_name: str, conf):
+        if isinstance(conf, str):
+            conf = {"column": conf}
+        self.table_name = table_name
+        self.composite = "columns" in conf
+        self.columns = list(conf["columns"]) if self.composite else [conf["column"]]
+        self.name = conf.get("name", '_'.join(self.columns))
+        self.unique = conf.get("unique", False)
+        self.casefold = conf.get("casefold", False)
+        self.entries = {}
+
+    def normalize(self, value):
+        if self.composite:
+            return tuple(self.__normalize_one(v) for v in value)
+        return self.__normalize_one(value)
+
+    def __normalize_one(self, value):
+        if self.casefold and isinstance(value, str):
+            return value.casefold()
+        return value
+
+    def key(self, row: dict):
+        if self.composite:
+            return tuple(self.__normalize_one(row[c]) for c in self.columns)
+        return self.__normalize_one(row[self.columns[0]])
+
+    def check(self, row: dict):
+        if not self.unique:
+            return
+        key = self.key(row)
+        if key in self.entries and self.entries[key] is not row:
+            raise UniqueConstraintError(self.table_name, self.name, key)
+
+    def add(self, row: dict):
+        key = self.key(row)
+        if self.unique:
+            self.entries[key] = row
+        elif key not in self.entries:
+            self.entries[key] = [row]
+        else:
+            self.entries[key].append(row)
+
+    def remove(self, row: dict):
+        key = self.key(row)
+        if key not in self.entries:
+            return
+        if self.unique:
+            if self.entries[key] is row:
+                del self.entries[key]
+            return
+        rows = self.entries[key]
+        for i in range(len(rows)):
+            if row is rows[i]:
+                del rows[i]
+                if len(rows) == 0:
+                    del self.entries[key]
+                return
+
+    def clear(self):
+        self.entries = {}
+
+    def get(self, value, default=None):
+        return self.entries.get(self.normalize(value), default)
+
+    def __contains__(self, value):
+        return self.normalize(value) in self.entries
+
+    def __getitem__(self, value):
+        return self.entries[self.normalize(value)]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
 
 class TableContext(object):
     """
-    Basic database context implementation
+    Basic table context implementation
+
+    Rows are kept in insertion order by stable id, removal does not
+    renumber remaining rows.
     """
 
-    def __init__(self, name: str, table: list, indexes: dict):
+    def __init__(self, name: str, index_conf: list):
         self.name = name
-        self.table = table
-        self.indexes = indexes
+        self.rows = {}
+        self.next_id = 0
+        self.listeners = []
+        if index_conf is None:
+            self.indexes = None
+        else:
+            indexes = [TableIndex(name, conf) for conf in index_conf]
+            self.indexes = {index.name: index for index in indexes}
+
+    def subscribe(self, listener):
+        """ listener(event, table, row) is called after each add, update, remove, clear and load """
+        self.listeners.append(listener)
+
+    def _notify(self, event: str, row: dict = None):
+        for listener in self.listeners:
+            listener(event, self, row)
+
+    def __check_index(self, row: dict):
+        if self.indexes is None:
+            return
+        for index in self.indexes.values():
+            index.check(row)
 
     def __add_to_index(self, row: dict):
         if self.indexes is None:
             return
-        for column_name in self.indexes:
-            index = self.indexes[column_name]
-            value = row[column_name]
-            if value not in index:
-                index[value] = [row]
-            else:
-                index[value].append(row)
+        for index in self.indexes.values():
+            index.add(row)
 
     def __remove_from_index(self, row: dict):
         if self.indexes is None:
             return
-        for column_name in self.indexes:
-            index = self.indexes[column_name]
-            value = row[column_name]
-            if value not in index:
-                return
-            rows = index[value]
-            for i in range(len(rows)):
-                if row is rows[i]:
-                    del rows[i]
-                    if len(rows) == 0:
-                        del index[value]
-                    return
-
-    def __enumerate(self):
-        for i, row in enumerate(self.table):
-            row['id'] = i
+        for index in self.indexes.values():
+            index.remove(row)
 
     def build_index(self):
         if self.indexes is None:
             return
-        for column in self.indexes:
-            self.indexes[column] = {}
-        for row in self.table:
+        for index in self.indexes.values():
+            index.clear()
+        for row in self.rows.values():
+            try:
+                self.__check_index(row)
+            except UniqueConstraintError as e:
+                # Keep stored data loadable, first row wins
+                log.warn(f'{e}, row {row["id"]} is not indexed')
+                continue
             self.__add_to_index(row)
 
+    def clear(self):
+        # Ids are never reused
+        self.rows = {}
+        self.build_index()
+        self._notify('clear')
+
+    def dump(self):
+        return list(self.rows.values())
+
+    def load(self, rows: list):
+        self.rows = {}
+        for row in rows:
+            if 'id' not in row:
+                row['id'] = self.next_id
+            self.rows[row['id']] = row
+            self.next_id = max(self.next_id, row['id'] + 1)
+        self.build_index()
+
+    def replay(self, event: str, arg):
+        """ Apply journal record without touching indexes, replaying twice is harmless """
+        if event == 'add':
+            self.rows[arg['id']] = arg
+            self.next_id = max(self.next_id, arg['id'] + 1)
+        elif event == 'remove':
+            self.rows.pop(arg, None)
+        elif event == 'clear':
+            self.rows = {}
+
     def add(self, row: dict):
-        row['id'] = self.size()
-        self.table.append(row)
+        self.__check_index(row)
+        row['id'] = self.next_id
+        self.next_id += 1
+        self.rows[row['id']] = row
+        self.__add_to_index(row)
+        self._notify('add', row)
+
+    def update(self, row: dict, values: dict):
+        old_values = {k: row[k] for k in values if k in row}
+        self.__remove_from_index(row)
+        row.update(values)
+        try:
+            self.__check_index(row)
+        except UniqueConstraintError:
+            for k in values:
+                if k not in old_values:
+                    del row[k]
+            row.update(old_values)
+            self.__add_to_index(row)
+            raise
         self.__add_to_index(row)
+        self._notify('update', row)
 
     def remove(self, row: dict):
         id = row['id']
-        table_size = len(self.table)
-        if id < 0 or id >= table_size:
-            raise IndexError(f'No such id {id} in table "{self.name}"({table_size})')
-        del self.table[id]
+        if self.rows.get(id) is not row:
+            raise IndexError(f'No such id {id} in table "{self.name}"')
+        del self.rows[id]
         self.__remove_from_index(row)
-        self.__enumerate()
+        self._notify('remove', row)
+
+    def find(self, **predicates):
+        """
+        Rows matching all predicates (column or index name = value)
+
+        Candidates come from the most selective index among predicates,
+        the rest of predicates are checked on candidates only. Without
+        any indexed predicate whole table is scanned.
+        """
+        candidates = None
+        for name, value in predicates.items():
+            if self.indexes is None or name not in self.indexes:
+                continue
+            index = self.indexes[name]
+            found = index.get(value)
+            rows = [] if found is None else [found] if index.unique else found
+            if candidates is None or len(rows) < len(candidates):
+                candidates = rows
+        if candidates is None:
+            candidates = self
+        return [row for row in candidates if self.match(row, predicates)]
+
+    def match(self, row: dict, predicates: dict):
+        for name, value in predicates.items():
+            if self.indexes is not None and name in self.indexes:
+                index = self.indexes[name]
+                if index.key(row) != index.normalize(value):
+                    return False
+            elif row.get(name) != value:
+                return False
+        return True
 
     def __getitem__(self, id: int):
-        table_size = len(self.table)
-        if id < 0 or id >= table_size:
-            raise IndexError(f'No such id {id} in table "{self.name}"({table_size})')
-        return self.table[id]
+        if id not in self.rows:
+            raise IndexError(f'No such id {id} in table "{self.name}"')
+        return self.rows[id]
 
     def __getattr__(self, column: str):
-        if column not in self.indexes:
+        if column == 'indexes' or self.indexes is None or column not in self.indexes:
             raise AttributeError(f'No such column index "{column}" for table "{self.name}"')
         return self.indexes[column]
 
     def __iter__(self):
-       return self.table.__iter__()
+       return iter(self.rows.values())
 
     def __contains__(self, row: dict):
-        id = row['id']
-        return 0 <= id < len(self.table) and row is self.table[id]
+        return self.rows.get(row['id']) is row
 
     def size(self):
-        return len(self.table)
+        return len(self.rows)
 
     def __len__(self):
         return self.size()
 
+###################
+# SQLite backend  #
+###################
 
+def make_database_context(name, defaults: dict = None):
+    """
+    Make context with backend selected by db.<name>.backend ("json" or "sqlite")
+
+    defaults are used for settings absent in db.<name>
+    """
+    backend = config_path(f"db.{name}.backend", (defaults or {}).get("backend", "json"))
+    if backend == "sqlite":
+        return SqliteDatabaseContext(name, defaults)
+    if backend != "json":
+        raise InvalidConfigException(f'Unknown backend "{backend}" for {name} database', f'db.{name}.backend')
+    return DatabaseContext(name, defaults)
+
+def quote_sql(name: str):
+    return '"' + name.replace('"', '""') + '"'
+
+class SqliteDatabaseContext(DatabaseContext):
+    """
+    Database context stored in SQLite file
+
+    Rows live on disk, configured indexes are SQL indexes over copies
+    of indexed columns. Only rows being used are kept in memory.
+    """
+
+    def __init__(self, name, defaults: dict = None):
+
+        self.name = name
+        self.defaults = defaults or {}
+        self.tables = {}
+        self.path = self._config("path", None)
+        # Autocommit, each change is a transaction
+        self.connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        table_conf = self._config("tables", {})
+        index_conf = self._config("indexes", {})
+
+        for table in table_conf:
+            self.tables[table] = SqliteTableContext(self.connection, table, index_conf.get(table, None))
+
+    def build_index(self):
+        pass
+
+    def save(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    def load(self):
+        pass
+
+class SqliteTableContext(TableContext):
+    """
+    Table context stored in SQLite table
+    """
+
+    def __init__(self, connection: sqlite3.Connection, name: str, index_conf: list):
+        super().__init__(name, None)
+        self.connection = connection
+        self.sql_name = quote_sql(name)
+        if index_conf is not None:
+            indexes = [SqliteIndex(self, conf) for conf in index_conf]
+            self.indexes = {index.name: index for index in indexes}
+        # Normalized index keys are copied to columns covered by SQL indexes
+        self.columns = [c for index in self.__indexes() for c in index.sql_columns]
+
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {self.sql_name} (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)')
+        self.__migrate()
+        for index in self.__indexes():
+            index.create()
+
+    def __indexes(self):
+        return list(self.indexes.values()) if self.indexes is not None else []
+
+    def __migrate(self):
+        existing = [info[1] for info in self.connection.execute(f'PRAGMA table_info({self.sql_name})')]
+        missing = [c for c in self.columns if c not in existing]
+        for column in missing:
+            self.connection.execute(f'ALTER TABLE {self.sql_name} ADD COLUMN {quote_sql(column)}')
+        # Fill columns of newly declared indexes
+        if len(missing) > 0:
+            for row in list(self.select()):
+                self.__write(row)
+
+    def _row(self, id: int, data: str):
+        row = json.loads(data)
+        row['id'] = id
+        return row
+
+    def _data(self, row: dict):
+        return json.dumps({k: v for k, v in row.items() if k != 'id'})
+
+    def _index_values(self, row: dict):
+        values = []
+        for index in self.__indexes():
+            key = index.key(row)
+            values += list(key) if index.composite else [key]
+        return tuple(values)
+
+    def select(self, where: str = '', args: tuple = ()):
+        cursor = self.connection.execute(f'SELECT id, data FROM {self.sql_name} {where} ORDER BY id', args)
+        while True:
+            chunk = cursor.fetchmany(256)
+            if len(chunk) == 0:
+                return
+            for id, data in chunk:
+                yield self._row(id, data)
+
+    def build_index(self):
+        pass
+
+    def clear(self):
+        self.connection.execute(f'DELETE FROM {self.sql_name}')
+        self._notify('clear')
+
+    def dump(self):
+        return list(self.select())
+
+    def load(self, rows: list):
+        self.connection.execute(f'DELETE FROM {self.sql_name}')
+        for row in rows:
+            self.__insert(row)
+
+    def __check_index(self, row: dict):
+        for index in self.__indexes():
+            index.check(row)
+
+    def __insert(self, row: dict):
+        names = ''.join(f', {quote_sql(c)}' for c in self.columns)
+        marks = ', ?' * len(self.columns)
+        values = self._index_values(row)
+        if 'id' in row:
+            self.connection.execute(f'INSERT INTO {self.sql_name} (id, data{names}) VALUES (?, ?{marks})', (row['id'], self._data(row)) + values)
+        else:
+            cursor = self.connection.execute(f'INSERT INTO {self.sql_name} (data{names}) VALUES (?{marks})', (self._data(row),) + values)
+            row['id'] = cursor.lastrowid
+
+    def __write(self, row: dict):
+        assignments = ''.join(f', {quote_sql(c)} = ?' for c in self.columns)
+        args = (self._data(row),) + self._index_values(row) + (row['id'],)
+        self.connection.execute(f'UPDATE {self.sql_name} SET data = ?{assignments} WHERE id = ?', args)
+
+    def add(self, row: dict):
+        row.pop('id', None)
+        self.__check_index(row)
+        self.__insert(row)
+        self._notify('add', row)
+
+    def update(self, row: dict, values: dict):
+        updated = dict(row)
+        updated.update(values)
+        self.__check_index(updated)
+        row.update(values)
+        self.__write(row)
+        self._notify('update', row)
+
+    def remove(self, row: dict):
+        id = row['id']
+        cursor = self.connection.execute(f'DELETE FROM {self.sql_name} WHERE id = ?', (id,))
+        if cursor.rowcount == 0:
+            raise IndexError(f'No such id {id} in table "{self.name}"')
+        self._notify('remove', row)
+
+    def __getitem__(self, id: int):
+        for row in self.select('WHERE id = ?', (id,)):
+            return row
+        raise IndexError(f'No such id {id} in table "{self.name}"')
+
+    def __iter__(self):
+        return self.select()
+
+    def __contains__(self, row: dict):
+        cursor = self.connection.execute(f'SELECT 1 FROM {self.sql_name} WHERE id = ?', (row['id'],))
+        return cursor.fetchone() is not None
+
+    def size(self):
+        return self.connection.execute(f'SELECT COUNT(*) FROM {self.sql_name}').fetchone()[0]
+
+class SqliteIndex(TableIndex):
+    """
+    Index over SQLite table columns, same interface as TableIndex
+    """
+
+    def __init__(self, table: SqliteTableContext, conf):
+        super().__init__(table.name, conf)
+        self.table = table
+        self.sql_columns = [f'{self.name}__{i}' for i in range(len(self.columns))]
+        self.where = ' AND '.join(f'{quote_sql(c)} = ?' for c in self.sql_columns)
+
+    def create(self):
+        connection = self.table.connection
+        index_name = quote_sql(f'{self.table.name}_{self.name}')
+        columns = ', '.join(quote_sql(c) for c in self.sql_columns)
+        try:
+            unique = 'UNIQUE ' if self.unique else ''
+            connection.execute(f'CREATE {unique}INDEX IF NOT EXISTS {index_name} ON {self.table.sql_name} ({columns})')
+        except sqlite3.IntegrityError as e:
+            # Stored duplicates, uniqueness is still checked on changes
+            log.warn(f'Failed to create unique index "{self.name}" in table "{self.table.name}": {e}')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {self.table.sql_name} ({columns})')
+
+    def __args(self, key):
+        return tuple(key) if self.composite else (key,)
+
+    def __rows(self, key):
+        return list(self.table.select('WHERE ' + self.where, self.__args(key)))
+
+    def check(self, row: dict):
+        if not self.unique:
+            return
+        key = self.key(row)
+        cursor = self.table.connection.execute(f'SELECT id FROM {self.table.sql_name} WHERE {self.where} LIMIT 1', self.__args(key))
+        found = cursor.fetchone()
+        if found is not None and found[0] != row.get('id'):
+            raise UniqueConstraintError(self.table_name, self.name, key)
+
+    def add(self, row: dict):
+        pass
+
+    def remove(self, row: dict):
+        pass
+
+    def clear(self):
+        pass
+
+    def get(self, value, default=None):
+        rows = self.__rows(self.normalize(value))
+        if len(rows) == 0:
+            return default
+        return rows[0] if self.unique else rows
+
+    def __contains__(self, value):
+        key = self.normalize(value)
+        cursor = self.table.connection.execute(f'SELECT 1 FROM {self.table.sql_name} WHERE {self.where} LIMIT 1', self.__args(key))
+        return cursor.fetchone() is not None
+
+    def __getitem__(self, value):
+        result = self.get(value)
+        if result is None:
+            raise KeyError(value)
+        return result
+
+    def __iter__(self):
+        columns = ', '.join(quote_sql(c) for c in self.sql_columns)
+        cursor = self.table.connection.execute(f'SELECT DISTINCT {columns} FROM {self.table.sql_name}')
+        return (values if self.composite else values[0] for values in cursor)
+
+    def __len__(self):
+        return sum(1 for _ in self)
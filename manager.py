@@ -19,14 +19,18 @@ import asyncio
 import os
 import requests
 import re
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import UUID
 
 import discord
 import bot
 import config
 from util import *
-from mcuuid import GetPlayerData
+from mcuuid import PlayerCache, MojangClient, MojangUnavailableError, BULK_LOOKUP_LIMIT
 from pydactyl import PterodactylClient
-from db import DatabaseContext
+from db import make_database_context, write_file, write_json, UniqueConstraintError
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -71,26 +75,43 @@ The profile has been removed but don't worry. Here is copy of your message:
 # Module db context #
 #####################
 
+# Deploy tracking is internal, works without db.deploy in config
+DEPLOY_DB_DEFAULTS = {
+    "path": "deploy.json",
+    "flush_delay": 5,
+    "tables": ["root", "ranks"],
+    "indexes": {
+        "root": [{"columns": ["server", "artifact"], "name": "target", "unique": True}],
+        "ranks": [
+            {"columns": ["server", "ign", "rank"], "name": "entry", "unique": True, "casefold": True},
+            {"column": "server"}
+        ]
+    }
+}
+
 class DB:
-    dynamic = DatabaseContext('dynamic')
-    persist = DatabaseContext('persist')
-    ranks = DatabaseContext('ranks')
+    dynamic = make_database_context('dynamic')
+    persist = make_database_context('persist')
+    ranks = make_database_context('ranks')
+    deploy = make_database_context('deploy', DEPLOY_DB_DEFAULTS)
 
     @staticmethod
-    def save():
-        DB.persist.save()
-        DB.ranks.save()
+    async def flush():
+        await DB.persist.flush()
+        await DB.ranks.flush()
+        await DB.deploy.flush()
 
     @staticmethod
     def load():
         DB.persist.load()
         DB.ranks.load()
+        DB.deploy.load()
 
     @staticmethod
     def remove_dynamic(msg_id):
         for table in DB.dynamic:
             if msg_id in table.msg_id:
-                res = table.msg_id[msg_id][0]
+                res = table.msg_id[msg_id]
                 table.remove(res)
                 return res
         return None
@@ -98,7 +119,7 @@ class DB:
     @staticmethod
     def find_dynamic_whitelisted(ign):
         if ign in DB.dynamic.valid.ign:
-            return DB.dynamic.valid.ign[ign][0]
+            return DB.dynamic.valid.ign[ign]
         elif config_path("manager.profile.deprecated.whitelist", False):
             if ign in DB.dynamic.deprecated.ign:
                 return DB.dynamic.deprecated.ign[ign][0]
@@ -107,65 +128,199 @@ class DB:
     @staticmethod
     def remove_all_by_user(user: discord.User):
         res = []
-        for table in DB.dynamic:
-            for profile in table:
-                it_user = profile['msg'].author
-                if user.id == it_user.id:
-                    res.append(profile)
-                    table.remove(profile)
+        for table, profile in DB.dynamic.find(author_id=user.id):
+            res.append(profile)
+            table.remove(profile)
         return res
 
 
+players = PlayerCache(
+    config_path("mojang.cache.path", None),
+    ttl=config_path("mojang.cache.ttl", 86400),
+    negative_ttl=config_path("mojang.cache.negative_ttl", 3600),
+    size=config_path("mojang.cache.size", 10000)
+)
+
+mojang = MojangClient(
+    players,
+    timeout=config_path("mojang.timeout", 10),
+    concurrency=config_path("mojang.concurrency", 4),
+    rate=config_path("mojang.rate", 5),
+    burst=config_path("mojang.burst", 10),
+    retries=config_path("mojang.retries", 5),
+    backoff=config_path("mojang.backoff", 1)
+)
+
 ptero = PterodactylClient('http://' + os.environ.get("PTERODACTYL_DOMAIN"), os.environ.get("PTERODACTYL_TOKEN"))
 
 ##########################
 # Profile utility funcs  #
 ##########################
 
-def parse_dynamic_profile(profile_msg: discord.Message):
-    profile = parse_colon_seperated(profile_msg.content)
+class ProfileRecord(object):
+    """
+    Dynamic profile row
+
+    Keeps only ids, author details, parsed fields and player data instead
+    of the whole message, which is fetched again when it has to be deleted.
+    Item access (record['ign']) reads attributes, as db tables expect.
+    """
+
+    __slots__ = ('id', 'msg_id', 'channel_id', 'edited_at',
+                 'author_id', 'author_name', 'author_discriminator', 'author_display_name', 'author_member',
+                 'fields', 'ign', 'uuid', 'username', 'valid', 'error', 'lookup_error')
+
+    def __init__(self, msg_id: int, channel_id: int, edited_at: float, author: dict, fields: dict):
+        self.id = None
+        self.msg_id = msg_id
+        self.channel_id = channel_id
+        self.edited_at = edited_at
+        self.author_id = author['id']
+        self.author_name = author['name']
+        self.author_discriminator = author['discriminator']
+        self.author_display_name = author['display_name']
+        self.author_member = author['member']
+        self.fields = fields
+        self.ign = fields.get('ign', None)
+        # Player data, valid is None until ign is checked
+        self.uuid = None
+        self.username = None
+        self.valid = None
+        self.error = None
+        self.lookup_error = None
+
+    @staticmethod
+    def from_message(message: discord.Message, fields: dict):
+        user = message.author
+        author = {
+            'id': user.id,
+            'name': user.name,
+            'discriminator': user.discriminator,
+            'display_name': user.display_name,
+            'member': is_user_member(user)
+        }
+        edited_at = message.edited_at.timestamp() if message.edited_at is not None else None
+        return ProfileRecord(message.id, message.channel.id, edited_at, author, fields)
+
+    @staticmethod
+    def load(data: dict):
+        record = ProfileRecord(data['msg_id'], data['channel_id'], data['edited_at'], data['author'], data['fields'])
+        record.uuid, record.username, record.valid = data['player']
+        record.error = data['error']
+        record.lookup_error = data['lookup_error']
+        return record
+
+    def dump(self):
+        author = {
+            'id': self.author_id,
+            'name': self.author_name,
+            'discriminator': self.author_discriminator,
+            'display_name': self.author_display_name,
+            'member': self.author_member
+        }
+        return {
+            'msg_id': self.msg_id,
+            'channel_id': self.channel_id,
+            'edited_at': self.edited_at,
+            'author': author,
+            'fields': self.fields,
+            'player': [self.uuid, self.username, self.valid],
+            'error': self.error,
+            'lookup_error': self.lookup_error
+        }
+
+    def set_player(self, player):
+        self.valid = player.valid
+        if player.valid:
+            self.uuid = player.uuid.int
+            self.username = player.username
+
+    @property
+    def author_tag(self):
+        return f'{self.author_name}#{self.author_discriminator}'
+
+    @property
+    def mention(self):
+        return f'<@{self.author_id}>'
+
+    async def fetch_message(self, client: bot.DiscordBot):
+        channel = client.get_channel(self.channel_id)
+        return await channel.fetch_message(self.msg_id)
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key: str):
+        return hasattr(self, key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default)
+
+    def update(self, values: dict):
+        for key, value in values.items():
+            setattr(self, key, value)
+
+async def lookup_profile_player(profile: ProfileRecord):
+    profile.lookup_error = None
+    if profile.ign is None:
+        return
+    try:
+        profile.set_player(await mojang.lookup(profile.ign))
+    except MojangUnavailableError as e:
+        profile.lookup_error = str(e)
+
+def parse_profile_fields(profile_msg: discord.Message):
+    fields = parse_colon_seperated(profile_msg.content)
     to_filter = config_path("manager.profile.format.filter", [])
     for key in to_filter:
-        del profile[key]
-    profile["msg"] = profile_msg
-    profile["msg_id"] = profile_msg.id
-    if 'ign' in profile:
-        profile["player"] = GetPlayerData(profile["ign"])
+        fields.pop(key, None)
+    return fields
+
+async def parse_dynamic_profile(profile_msg: discord.Message):
+    profile = ProfileRecord.from_message(profile_msg, parse_profile_fields(profile_msg))
+    await lookup_profile_player(profile)
     return profile
 
-REQUIRED_DYNAMIC_PROFILE_ENTRIES = ['ign', 'msg', 'msg_id', 'player']
-def is_full_profile(profile: dict):
-    if profile is None:
-        return False
-    required = config_path("manager.profile.format.require", []) + REQUIRED_DYNAMIC_PROFILE_ENTRIES
-    if not has_keys(profile, required):
+async def delete_profile_message(client: bot.DiscordBot, profile: ProfileRecord, message: discord.Message = None):
+    if message is None:
+        message = await profile.fetch_message(client)
+    await message.delete()
+
+def is_admin_profile(client: bot.DiscordBot, profile: ProfileRecord, message: discord.Message = None):
+    user = message.author if message is not None else client.guild.get_member(profile.author_id)
+    return user is not None and is_user_member(user) and is_admin_user(user)
+
+def is_full_profile(profile: ProfileRecord):
+    if profile is None or profile.valid is None:
         return False
-    for key in required:
-        if profile[key] == "":
-            return False
-    return True
+    return len(get_missing_entries(profile)) == 0
 
-def make_persist_profile(message: discord.Message, ign: str):
-    player = GetPlayerData(ign)
+async def make_persist_profile(message: discord.Message, ign: str):
+    player = await mojang.lookup(ign)
     if not player.valid:
         return None
     return {
-        'ign': ign,
+        'ign': player.username,
         'author': message.author.id,
         'uuid': str(player.uuid)
     }
 
-def get_missing_entries(profile: dict):
+def get_missing_entries(profile: ProfileRecord):
     required = config_path("manager.profile.format.require", []) + ['ign']
     required = list(set(required))
-    required = [e for e in required if e not in profile]
+    required = [e for e in required if profile.fields.get(e, "") == ""]
     return required
 
-def dynamic_profile_to_whitelist_row(row):
-    player = row['player']
+def dynamic_profile_to_whitelist_row(row: ProfileRecord):
     return {
-        'uuid' : str(player.uuid),
-        'name' : player.username
+        'uuid' : str(UUID(int=row.uuid)),
+        'name' : row.username
     }
 
 def persist_profile_to_whitelist_row(row):
@@ -174,16 +329,17 @@ def persist_profile_to_whitelist_row(row):
         'name' : row['ign']
     }
 
-def dumps_dynamic_profile(row: dict, pretty=False):
-    keys = [k for k in row if k not in ['msg', 'player']]
-    obj = {}
-    for k in keys:
-        obj[k] = row[k]
-    if 'msg' in row:
-        obj['user'] = row['msg'].author.name
-    if 'player' in row and row['player'].valid:
-        obj['ign'] = row['player'].username
-        obj['uuid'] = str(row['player'].uuid)
+def dumps_dynamic_profile(row: ProfileRecord, pretty=False):
+    obj = dict(row.fields)
+    obj['msg_id'] = row.msg_id
+    obj['user'] = row.author_name
+    if row.error is not None:
+        obj['error'] = row.error
+    if row.lookup_error is not None:
+        obj['lookup_error'] = row.lookup_error
+    if row.valid:
+        obj['ign'] = row.username
+        obj['uuid'] = str(UUID(int=row.uuid))
     if pretty:
         return json.dumps(obj, indent=4, sort_keys=True)
     return json.dumps(obj)
@@ -194,371 +350,1433 @@ def dumps_presist_profile(row: dict, pretty=False):
     return json.dumps(row)
 
 #####################
-# Whitelist Methods #
+# Deploy Methods    #
 #####################
 
-def build_whitelist_json():
-    ign_set = set()
-    whitelist = []
+def content_hash(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+def is_deployed(srv_id: str, artifact: str, digest: str):
+    row = DB.deploy.root.target.get((srv_id, artifact))
+    return row is not None and row['hash'] == digest
+
+def mark_deployed(srv_id: str, artifact: str, digest: str):
+    row = DB.deploy.root.target.get((srv_id, artifact))
+    if row is None:
+        DB.deploy.root.add({'server': srv_id, 'artifact': artifact, 'hash': digest})
+    elif row['hash'] != digest:
+        DB.deploy.root.update(row, {'hash': digest})
+
+class DeployResult(object):
+    """
+    Outcome of deploying to single server: ok, skipped or failed
+    """
+
+    def __init__(self, server: str, status: str, duration: float = 0, error: str = None):
+        self.server = server
+        self.status = status
+        self.duration = duration
+        self.error = error
+
+    def __str__(self):
+        if self.status == 'skipped':
+            return f'[{self.server}] skipped, up to date'
+        res = f'[{self.server}] {self.status} in {self.duration:.1f}s'
+        return res if self.error is None else f'{res}: {self.error}'
+
+deploy_executor = None
+deploy_semaphore = None
+
+def get_deploy_executor():
+    # Blocking SFTP and panel calls are kept off event loop, spare workers
+    # are left for threads stuck in timed out jobs
+    global deploy_executor
+    if deploy_executor is None:
+        workers = 2 * config_path("manager.deploy.concurrency", 4)
+        deploy_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='deploy')
+    return deploy_executor
+
+def get_deploy_semaphore():
+    # Shared by all artifacts
+    global deploy_semaphore
+    if deploy_semaphore is None:
+        deploy_semaphore = asyncio.Semaphore(config_path("manager.deploy.concurrency", 4))
+    return deploy_semaphore
+
+async def run_blocking(func, *args):
+    return await asyncio.get_event_loop().run_in_executor(get_deploy_executor(), func, *args)
+
+class ServerInventory(object):
+    """
+    Pterodactyl servers cached for ttl seconds
+
+    Expired inventory is fetched again on next get(), background task
+    refreshes it every ttl seconds. Listeners are called with ids of
+    servers appeared since previous refresh.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # srv_id -> server attributes
+        self.servers = {}
+        self.updated_at = None
+        self.listeners = []
+        self.refreshing = None
+        self.task = None
+
+    def subscribe(self, listener):
+        """ listener(added) is called after refresh finds new servers """
+        self.listeners.append(listener)
+
+    def age(self):
+        return None if self.updated_at is None else time.time() - self.updated_at
+
+    def expired(self):
+        return self.updated_at is None or self.age() > self.ttl
+
+    async def refresh(self):
+        # Concurrent callers share single request
+        if self.refreshing is None:
+            self.refreshing = asyncio.ensure_future(self.__fetch())
+        refreshing = self.refreshing
+        try:
+            return await asyncio.shield(refreshing)
+        finally:
+            if refreshing.done() and self.refreshing is refreshing:
+                self.refreshing = None
+
+    async def __fetch(self):
+        response = await run_blocking(ptero.client.list_servers)
+        servers = {s['attributes']['identifier']: s['attributes'] for s in response.data['data']}
+        first = self.updated_at is None
+        added = [srv_id for srv_id in servers if srv_id not in self.servers]
+        removed = [srv_id for srv_id in self.servers if srv_id not in servers]
+        self.servers = servers
+        self.updated_at = time.time()
+        if not first and len(added) + len(removed) > 0:
+            log.info(f'Server inventory changed: added {added}, removed {removed}')
+            for listener in self.listeners:
+                listener(added)
+        return servers
+
+    async def get(self):
+        if self.expired():
+            await self.refresh()
+        return self.servers
+
+    async def __refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.refresh()
+            except Exception as e:
+                log.warn(f'Failed to refresh server inventory: {e}')
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.__refresh_loop())
+
+inventory = ServerInventory(config_path("manager.deploy.inventory_ttl", 600))
+
+async def list_server_ids(only: list = None):
+    servers = await inventory.get()
+    return [srv_id for srv_id in servers if only is None or srv_id in only]
+
+async def deploy_servers(name: str, jobs: dict):
+    """
+    Run blocking deploy jobs (server id -> function or None if up to date)
+    concurrently, each within manager.deploy.timeout seconds
+
+    Hung job keeps its worker thread until it returns, but does not
+    delay other servers.
+    """
+    timeout = config_path("manager.deploy.timeout", 60)
+    semaphore = get_deploy_semaphore()
+
+    async def deploy(srv_id, job):
+        if job is None:
+            return DeployResult(srv_id, 'skipped')
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(run_blocking(job), timeout)
+            except asyncio.TimeoutError:
+                return DeployResult(srv_id, 'failed', time.monotonic() - start, f'timed out after {timeout}s')
+            except Exception as e:
+                return DeployResult(srv_id, 'failed', time.monotonic() - start, str(e))
+            return DeployResult(srv_id, 'ok', time.monotonic() - start)
+
+    results = await asyncio.gather(*[deploy(srv_id, job) for srv_id, job in jobs.items()])
+
+    for result in results:
+        if result.status == 'failed':
+            log.warn(f'{name.capitalize()} deploy failed {result}')
+        else:
+            log.info(f'{name.capitalize()} deploy {result}')
+    counts = {status: len([r for r in results if r.status == status]) for status in ['ok', 'skipped', 'failed']}
+    log.info(f'{name.capitalize()} deployed: {counts["ok"]} ok, {counts["skipped"]} skipped, {counts["failed"]} failed')
+    return results
 
-    def collect_whitelist(table, converter):
-        for profile in table:
-            if profile['ign'] in ign_set:
-                continue
-            wl_row = converter(profile)
-            whitelist.append(wl_row)
-            ign_set.add(profile['ign'])
+def format_deploy_results(name: str, results: list):
+    if len(results) == 0:
+        return f'{name.capitalize()}: no servers'
+    return f'{name.capitalize()}:\n' + '\n'.join(str(r) for r in results)
 
-    # Add valid
-    collect_whitelist(DB.dynamic.valid, dynamic_profile_to_whitelist_row)
+#####################
+# Whitelist Methods #
+#####################
 
-    # Add deprecated
+class WhitelistView(object):
+    """
+    Whitelist maintained from table change events
+
+    Sources are (table, converter) pairs in precedence order, ign is
+    whitelisted by its row from the first source having it. Rows are
+    counted per ign and source, so ign stays until its last row is
+    removed. Serialized whitelist is rebuilt only after it changes.
+    """
+
+    def __init__(self, sources: list):
+        self.sources = sources
+        # ign -> [{row id: row} per source]
+        self.entries = {}
+        # (source, row id) -> ign
+        self.keys = {}
+        # ign -> serialized whitelist row
+        self.fragments = {}
+        # ign -> (uuid, name) of whitelisted row
+        self.players = {}
+        self.data = None
+        self.players_set = None
+        self.version = 0
+        for level, (table, _) in enumerate(sources):
+            table.subscribe(lambda event, table, row, level=level: self.__handle(level, event, row))
+            self.__load(level)
+
+    def __handle(self, level: int, event: str, row):
+        if event == 'add':
+            self.__add(level, row)
+        elif event == 'remove':
+            self.__remove(level, row)
+        elif event == 'update':
+            self.__remove(level, row)
+            self.__add(level, row)
+        elif event in ('clear', 'load'):
+            for key in [k for k in self.keys if k[0] == level]:
+                self.__remove(level, {'id': key[1]})
+            if event == 'load':
+                self.__load(level)
+
+    def __load(self, level: int):
+        for row in self.sources[level][0]:
+            self.__add(level, row)
+
+    def __add(self, level: int, row):
+        # Igns are case-insensitive
+        ign = row['ign'].casefold()
+        self.keys[(level, row['id'])] = ign
+        if ign not in self.entries:
+            self.entries[ign] = [{} for _ in self.sources]
+        self.entries[ign][level][row['id']] = row
+        self.__refresh(ign)
+
+    def __remove(self, level: int, row):
+        ign = self.keys.pop((level, row['id']), None)
+        if ign is None:
+            return
+        entry = self.entries[ign]
+        del entry[level][row['id']]
+        if not any(entry):
+            del self.entries[ign]
+        self.__refresh(ign)
+
+    def __refresh(self, ign: str):
+        fragment = None
+        for level, rows in enumerate(self.entries.get(ign, [])):
+            if len(rows) > 0:
+                converter = self.sources[level][1]
+                wl_row = converter(next(iter(rows.values())))
+                fragment = json.dumps(wl_row)
+                break
+        if fragment == self.fragments.get(ign):
+            return
+        if fragment is None:
+            del self.fragments[ign]
+            del self.players[ign]
+        else:
+            self.fragments[ign] = fragment
+            self.players[ign] = (wl_row['uuid'], wl_row['name'])
+        self.data = None
+        self.players_set = None
+        self.version += 1
+
+    def dump(self):
+        """ Serialized whitelist and its version """
+        if self.data is None:
+            # Sorted by ign, bytes depend only on whitelisted players, not on event history
+            self.data = ('[' + ', '.join(self.fragments[ign] for ign in sorted(self.fragments)) + ']').encode()
+        return self.data, self.version
+
+    def whitelisted(self):
+        """ Whitelisted (uuid, name) pairs """
+        if self.players_set is None:
+            self.players_set = frozenset(self.players.values())
+        return self.players_set
+
+def make_whitelist_view():
+    sources = [(DB.dynamic.valid, dynamic_profile_to_whitelist_row)]
     if config_path("manager.profile.deprecated.whitelist", False):
-        collect_whitelist(DB.dynamic.deprecated, dynamic_profile_to_whitelist_row)
+        sources.append((DB.dynamic.deprecated, dynamic_profile_to_whitelist_row))
+    sources.append((DB.persist.root, persist_profile_to_whitelist_row))
+    return WhitelistView(sources)
+
+whitelist = make_whitelist_view()
+
+def ptero_whitelist_deploy(srv_id, data: bytes):
+    # Upload whitelist.json
+    if config_path("manager.whitelist.upload", False):
+        log.info(f"Uploading whitelist to [{srv_id}]")
+        ptero_sftp_upload(srv_id, data, "/whitelist.json")
+
+    if config_path("manager.whitelist.reload", False):
+        log.info(f"Reloading whitelist on [{srv_id}]")
+        try:
+            # Reload whitelist
+            ptero.client.send_console_command(srv_id, "whitelist reload")
+        except requests.exceptions.HTTPError as e:
+            raise RuntimeError("whitelist reload failed: " + str(e.response.content))
+
+def ptero_whitelist_delta_deploy(srv_id, added: set, removed: set, data: bytes):
+    log.info(f"Applying whitelist delta on [{srv_id}]: +{len(added)} -{len(removed)}")
+    try:
+        # Removed first, player may be re-added under new uuid
+        for _, name in sorted(removed, key=lambda e: e[1]):
+            ptero.client.send_console_command(srv_id, f"whitelist remove {name}")
+        for _, name in sorted(added, key=lambda e: e[1]):
+            ptero.client.send_console_command(srv_id, f"whitelist add {name}")
+    except requests.exceptions.HTTPError as e:
+        # State of server is unknown now, whole whitelist fixes it
+        log.warn(f"Whitelist delta on [{srv_id}] failed ({e.response.content}), uploading whole whitelist")
+        ptero_whitelist_deploy(srv_id, data)
+
+# Whitelist hash -> (uuid, name) set, kept for hashes deployed to some server
+deployed_whitelists = {}
+
+def whitelist_delta(srv_id: str, entries: frozenset):
+    """ (added, removed) against whitelist deployed to server or None if unknown """
+    row = DB.deploy.root.target.get((srv_id, 'whitelist'))
+    if row is None or row['hash'] not in deployed_whitelists:
+        return None
+    base = deployed_whitelists[row['hash']]
+    return entries - base, base - entries
 
-    # Add persist
-    collect_whitelist(DB.persist.root, persist_profile_to_whitelist_row)
-    
-    return json.dumps(whitelist)
+async def save_players():
+    """ Write player cache on disk off the event loop """
+    data = players.dump() if players.path is not None else None
+    if data is not None:
+        await asyncio.get_running_loop().run_in_executor(None, write_file, players.path, data)
 
-def sync_whitelist():
+async def sync_whitelist(force=False, servers: list = None):
     log.info("Syncing whitelist")
-    # Dump db and whitelist on disk
-    DB.save()
-    tmp_file_name = "whitelist.json"
-    with open(tmp_file_name, "w") as f:
-        f.write(build_whitelist_json())
+    # Dump db on disk
+    await DB.flush()
+    await save_players()
+    data, version = whitelist.dump()
+    digest = content_hash(data)
+    log.info(f"Whitelist version {version}, {len(whitelist.fragments)} players")
+
+    # Delta needs uploaded whitelist to fall back to
+    use_delta = config_path("manager.whitelist.delta.enabled", False) and config_path("manager.whitelist.upload", False)
+    max_changes = config_path("manager.whitelist.delta.max_changes", 20)
+    entries = whitelist.whitelisted()
     
     # Get servers from pterodactyl panel
-    servers = ptero.client.list_servers().data['data']
-
-    # Sync each server
-    for server in servers:
-        srv_id = server['attributes']['identifier']
-
+    jobs = {}
+    for srv_id in await list_server_ids(servers):
         if srv_id not in config_path("manager.whitelist.servers", []):
             continue
 
+        # Skip servers already having same whitelist
+        if not force and is_deployed(srv_id, 'whitelist', digest):
+            jobs[srv_id] = None
+            continue
 
-        # Upload whitelist.json
-        if config_path("manager.whitelist.upload", False):
-            log.info(f"Uploading whitelist to [{srv_id}]")
-            ptero_sftp_upload(srv_id, tmp_file_name, "/whitelist.json")
+        # Small change is sent as console commands
+        delta = whitelist_delta(srv_id, entries) if use_delta and not force else None
+        if delta is not None and len(delta[0]) + len(delta[1]) <= max_changes:
+            jobs[srv_id] = lambda srv_id=srv_id, delta=delta: ptero_whitelist_delta_deploy(srv_id, *delta, data)
+        else:
+            jobs[srv_id] = lambda srv_id=srv_id: ptero_whitelist_deploy(srv_id, data)
 
+    results = await deploy_servers('whitelist', jobs)
 
-        if config_path("manager.whitelist.reload", False):
-            log.info(f"Reloading whitelist on [{srv_id}]")
-            try:
-                # Reload whitelist
-                ptero.client.send_console_command(srv_id, "whitelist reload")
-            except requests.exceptions.HTTPError as e:
-                log.warn("whitelist reload failed: " + str(e.response.content))
-                continue
+    # Only uploaded whitelist counts as deployed
+    if config_path("manager.whitelist.upload", False):
+        for result in results:
+            if result.status == 'ok':
+                mark_deployed(result.server, 'whitelist', digest)
+    await DB.deploy.flush()
+
+    # Forget whitelists no server has anymore
+    if use_delta:
+        deployed_whitelists[digest] = entries
+        hashes = set(row['hash'] for row in DB.deploy.root if row['artifact'] == 'whitelist')
+        for old_digest in [d for d in deployed_whitelists if d not in hashes]:
+            del deployed_whitelists[old_digest]
+    return results
 
 #####################
 # Rank Methods      #
 #####################
 
-def sync_ranks():
+class RankRenderer(object):
+    """
+    Ranked players maintained from rank table change events
+
+    Keeps ign -> ranks map, entry of each ign is rendered in every format
+    when its ranks change. Formats are artifact -> function(ign, uuid,
+    ranks) returning entry text, rendered artifacts are joined once per
+    change and cached.
+    """
+
+    def __init__(self, tables: list, formats: dict):
+        self.tables = tables
+        self.order = {table.name: i for i, table in enumerate(tables)}
+        self.formats = formats
+        # ign -> {rank: row} in rank order
+        self.players = {}
+        # (rank, row id) -> ign
+        self.keys = {}
+        # ign -> {artifact: rendered entry}
+        self.fragments = {}
+        self.rendered = None
+        self.version = 0
+        for table in tables:
+            table.subscribe(self.__handle)
+            self.__load(table)
+
+    def __handle(self, event: str, table, row):
+        if event == 'add':
+            self.__add(table.name, row)
+        elif event == 'remove':
+            self.__remove(table.name, row)
+        elif event == 'update':
+            self.__remove(table.name, row)
+            self.__add(table.name, row)
+        elif event in ('clear', 'load'):
+            for key in [k for k in self.keys if k[0] == table.name]:
+                self.__remove(table.name, {'id': key[1]})
+            if event == 'load':
+                self.__load(table)
+
+    def __load(self, table):
+        for row in table:
+            self.__add(table.name, row)
+
+    def __add(self, rank: str, row):
+        # Igns are case-insensitive
+        ign = row['ign'].casefold()
+        self.keys[(rank, row['id'])] = ign
+        ranks = self.players.get(ign, {})
+        ranks[rank] = row
+        self.players[ign] = {r: ranks[r] for r in sorted(ranks, key=self.order.get)}
+        self.__refresh(ign)
+
+    def __remove(self, rank: str, row):
+        ign = self.keys.pop((rank, row['id']), None)
+        if ign is None:
+            return
+        del self.players[ign][rank]
+        if len(self.players[ign]) == 0:
+            del self.players[ign]
+        self.__refresh(ign)
+
+    def __refresh(self, ign: str):
+        if ign in self.players:
+            ranks = self.players[ign]
+            # Player data of highest rank
+            first = next(iter(ranks.values()))
+            entry = (first['ign'], first['uuid'].replace('-', ''), list(ranks))
+            self.fragments[ign] = {artifact: fmt(*entry) for artifact, fmt in self.formats.items()}
+        else:
+            self.fragments.pop(ign, None)
+        self.rendered = None
+        self.version += 1
+
+    def __position(self, ign: str):
+        # Players go in order of their first rank table and row in it
+        rank, row = next(iter(self.players[ign].items()))
+        return self.order[rank], row['id']
+
+    def get(self, ign: str):
+        """ {rank: row} of player """
+        return self.players.get(ign.casefold(), {})
+
+    def ranked(self):
+        """ (ign, rank) casefolded -> (ign, rank) of every ranked player """
+        res = {}
+        for ign, ranks in self.players.items():
+            for rank, row in ranks.items():
+                res[(ign, rank.casefold())] = (row['ign'], rank)
+        return res
+
+    def render(self):
+        """ Rendered artifacts (artifact -> bytes) """
+        if self.rendered is None:
+            # Stable order keeps hashes of unchanged ranks across restarts
+            fragments = [self.fragments[ign] for ign in sorted(self.players, key=self.__position)]
+            self.rendered = {artifact: '\n'.join(f[artifact] for f in fragments).encode() for artifact in self.formats}
+        return self.rendered
+
+def format_ftbu_player(ign: str, uuid: str, ranks: list):
+    return f'// {ign}\n[{uuid}]\nparent: {", ".join(ranks)}\n'
+
+def format_ftbu_player_ranks(ign: str, uuid: str, ranks: list):
+    return f'{ign}: {", ".join(ranks)}\n'
+
+# Artifact, destination path and format of FTBU rank files
+FTBU_RANK_FILES = [
+    ('ftbu_players', "/local/ftbutilities/players.txt", format_ftbu_player),
+    ('ftbu_ranks', "/local/ftbutilities/player_ranks.txt", format_ftbu_player_ranks)
+]
+
+rank_renderer = RankRenderer(list(DB.ranks), {artifact: fmt for artifact, _, fmt in FTBU_RANK_FILES})
+
+async def sync_ranks(force=False, servers: list = None):
     log.info("Syncing ranks")
     # Dump db on disk
-    DB.save()
-
-    # Get servers from pterodactyl panel
-    servers = ptero.client.list_servers().data['data']
+    await DB.flush()
 
     rank_systems = config_path("manager.rank.servers", [])
 
-    # Sync each server
-    for server in servers:
-        srv_id = server['attributes']['identifier']
+    # FTBU files are same for each server
+    rendered = rank_renderer.render()
+    ftbu_files = [(artifact, dst_path, rendered[artifact]) for artifact, dst_path, _ in FTBU_RANK_FILES]
+    desired_ranks = rank_renderer.ranked()
 
+    # Get servers from pterodactyl panel
+    jobs = {}
+    pending = {}
+    loop = asyncio.get_running_loop()
+    for srv_id in await list_server_ids(servers):
         if srv_id not in rank_systems:
             continue
 
         rank_system = rank_systems[srv_id]
 
         if rank_system == "spigot":
-            ptero_spigot_rank_sync(srv_id)
+            if not config_path("manager.rank.spigot.enabled", False):
+                continue
+            # Only changes since last applied ranks are sent
+            commands = spigot_rank_delta(srv_id, desired_ranks, force)
+            if len(commands) == 0:
+                jobs[srv_id] = None
+                continue
+            # Confirmed commands are recorded on loop, also those arriving after timeout
+            confirm = lambda command, srv_id=srv_id: loop.call_soon_threadsafe(mark_spigot_ranks_applied, srv_id, [command])
+            jobs[srv_id] = lambda srv_id=srv_id, commands=commands, confirm=confirm: ptero_spigot_rank_sync(srv_id, commands, confirm)
         elif rank_system == "ftbutilities":
-            ptero_ftbutilities_rank_sync(srv_id)
+            # Skip files server already has
+            files = [f for f in ftbu_files if force or not is_deployed(srv_id, f[0], content_hash(f[2]))]
+            if len(files) == 0:
+                jobs[srv_id] = None
+                continue
+            pending[srv_id] = files
+            jobs[srv_id] = lambda srv_id=srv_id, files=files: ptero_ftbutilities_rank_sync(srv_id, files)
 
-def build_ftbu_ranks_data():
-    entries = {}
+    results = await deploy_servers('ranks', jobs)
 
-    for table in DB.ranks:
-        for row in table:
-            ign = row['ign']
-            if ign in entries:
-                entries[ign]['ranks'].append(table.name)
+    if config_path("manager.rank.upload", False):
+        for result in results:
+            if result.status == 'ok':
+                for artifact, _, data in pending.get(result.server, []):
+                    mark_deployed(result.server, artifact, content_hash(data))
+    await DB.deploy.flush()
+    return results
+
+def ptero_ftbutilities_rank_sync(srv_id, files: list):
+    # Upload players.txt and player_ranks.txt
+    if config_path("manager.rank.upload", False):
+        log.info(f"Uploading {', '.join(f[1] for f in files)} to [{srv_id}]")
+        ptero_sftp_upload_many(srv_id, [(data, dst_path) for _, dst_path, data in files])
+
+def spigot_rank_delta(srv_id: str, desired: dict, force=False):
+    """
+    Commands (action, ign, rank) turning ranks applied on server into
+    desired ones ((ign, rank) casefolded -> (ign, rank)), forced delta
+    adds every desired rank again
+    """
+    applied = {}
+    for row in DB.deploy.ranks.server.get(srv_id, []):
+        applied[(row['ign'].casefold(), row['rank'].casefold())] = (row['ign'], row['rank'])
+    commands = [('remove', ign, rank) for key, (ign, rank) in applied.items() if key not in desired]
+    commands += [('add', ign, rank) for key, (ign, rank) in desired.items() if force or key not in applied]
+    return commands
+
+def mark_spigot_ranks_applied(srv_id: str, commands: list):
+    table = DB.deploy.ranks
+    for action, ign, rank in commands:
+        row = table.entry.get((srv_id, ign, rank))
+        if action == 'add' and row is None:
+            table.add({'server': srv_id, 'ign': ign, 'rank': rank})
+        elif action == 'remove' and row is not None:
+            table.remove(row)
+
+def ptero_spigot_rank_sync(srv_id, commands: list, confirm):
+    """
+    Send rank commands one by one, throttled and retried
+
+    confirm(command) is called for each command accepted by panel,
+    pipeline stops at first command failed after all retries.
+    """
+    templates = {
+        'add': config_path("manager.rank.spigot.add", "lp user {ign} parent add {rank}"),
+        'remove': config_path("manager.rank.spigot.remove", "lp user {ign} parent remove {rank}")
+    }
+    interval = config_path("manager.rank.spigot.interval", 0.2)
+    retries = config_path("manager.rank.spigot.retries", 3)
+    backoff = config_path("manager.rank.spigot.backoff", 1)
+
+    log.info(f"Sending {len(commands)} rank commands to [{srv_id}]")
+    for i, (action, ign, rank) in enumerate(commands):
+        if i > 0:
+            time.sleep(interval)
+        command = templates[action].format(ign=ign, rank=rank)
+        for attempt in range(retries + 1):
+            try:
+                ptero.client.send_console_command(srv_id, command)
+                break
+            except requests.exceptions.HTTPError as e:
+                if attempt == retries:
+                    raise RuntimeError(f'"{command}" failed: {e.response.content}')
+                time.sleep(backoff * 2 ** attempt)
+        confirm((action, ign, rank))
+
+#####################
+# Sync Scheduler    #
+#####################
+
+class SyncScheduler(object):
+    """
+    Coalescing runner of artifact sync
+
+    trigger() marks artifact dirty (on given servers or everywhere) and
+    returns future resolved with result of a sync started after the
+    trigger. Sync starts after delay seconds without triggers, but no
+    later than max_delay seconds after first pending trigger. Triggers
+    during sync are served by the next one. Forced and regular targets
+    are synced separately, forced first. Sync runs holding lock if set,
+    so it never sees db being reloaded.
+    """
+
+    def __init__(self, name: str, sync, delay: float, max_delay: float):
+        self.name = name
+        self.sync = sync
+        self.delay = delay
+        self.max_delay = max_delay
+        self.lock = None
+        # (future, force) pairs
+        self.waiters = []
+        # force -> server ids or None for all servers
+        self.targets = {}
+        self.first_trigger = None
+        self.handle = None
+        self.running = None
+
+    def trigger(self, force=False, servers: list = None):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        # Failures are logged, waiting for result is optional
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.waiters.append((future, force))
+        if servers is None or self.targets.get(force, set()) is None:
+            self.targets[force] = None
+        else:
+            self.targets[force] = self.targets.get(force, set()) | set(servers)
+        if self.first_trigger is None:
+            self.first_trigger = loop.time()
+        if self.running is None:
+            self.__schedule()
+        return future
+
+    def __schedule(self):
+        loop = asyncio.get_event_loop()
+        if self.handle is not None:
+            self.handle.cancel()
+        when = min(loop.time() + self.delay, self.first_trigger + self.max_delay)
+        self.handle = loop.call_at(when, self.__start)
+
+    def __start(self):
+        self.handle = None
+        waiters, targets = self.waiters, self.targets
+        self.waiters, self.targets, self.first_trigger = [], {}, None
+        self.running = asyncio.ensure_future(self.__run(waiters, targets))
+
+    async def __sync_targets(self, targets: dict):
+        outcomes = {}
+        for force in sorted(targets, reverse=True):
+            servers = targets[force]
+            # Forced sync of all servers covers regular one
+            if not force and targets.get(True, set()) is None:
+                outcomes[force] = outcomes[True]
+                continue
+            try:
+                result = await self.sync(force, None if servers is None else sorted(servers))
+                outcomes[force] = (result, None)
+            except Exception as e:
+                log.error(f'{self.name.capitalize()} sync failed: {e}')
+                outcomes[force] = (None, e)
+        return outcomes
+
+    async def __run(self, waiters: list, targets: dict):
+        log.info(f'Running {self.name} sync for {len(waiters)} changes')
+        try:
+            if self.lock is not None:
+                async with self.lock:
+                    outcomes = await self.__sync_targets(targets)
             else:
-                entries[ign] = {
-                    'ign': row['ign'],
-                    'uuid': row['uuid'].replace('-',''),
-                    'ranks': [table.name]
-                }
-    
-    entrie_format = '// {ign}\n[{uuid}]\nparent: {ranks}\n'
-    entrie_conv = lambda e: {'ign': e['ign'], 'uuid': e['uuid'], 'ranks': ', '.join(e['ranks'])}
+                outcomes = await self.__sync_targets(targets)
+            for future, force in waiters:
+                result, error = outcomes[force]
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+        finally:
+            self.running = None
+            if len(self.waiters) > 0:
+                self.__schedule()
+
+whitelist_sync = SyncScheduler(
+    'whitelist',
+    sync_whitelist,
+    delay=config_path("manager.sync.delay", 2),
+    max_delay=config_path("manager.sync.max_delay", 30)
+)
+
+ranks_sync = SyncScheduler(
+    'ranks',
+    sync_ranks,
+    delay=config_path("manager.sync.delay", 2),
+    max_delay=config_path("manager.sync.max_delay", 30)
+)
+
+async def trigger_sync(whitelist=False, ranks=False, force=False):
+    """ Trigger syncs of given artifacts at once, returns their results """
+    futures = []
+    if whitelist:
+        futures.append(whitelist_sync.trigger(force))
+    if ranks:
+        futures.append(ranks_sync.trigger(force))
+    try:
+        return await asyncio.gather(*futures)
+    except Exception:
+        # Already logged by scheduler
+        return None
+
+async def catch_up_servers(servers: list):
+    # Server might be reinstalled, stored hashes are ignored
+    log.info(f'Deploying to new servers {servers}')
+    # Failures are logged by scheduler
+    await asyncio.gather(
+        whitelist_sync.trigger(force=True, servers=servers),
+        ranks_sync.trigger(force=True, servers=servers),
+        return_exceptions=True
+    )
+
+def on_servers_added(added: list):
+    if len(added) > 0:
+        asyncio.ensure_future(catch_up_servers(added))
+
+inventory.subscribe(on_servers_added)
+
+#######################
+# Reconcile Methods   #
+#######################
+
+reconcile_task = None
+
+def collect_stored_players():
+    players_by_uuid = {}
+    for db in [DB.persist, DB.ranks]:
+        for table in db:
+            for row in table:
+                key = UUID(row['uuid'])
+                players_by_uuid.setdefault(key, []).append((db, table, row))
+    return players_by_uuid
+
+def apply_renames(players_by_uuid: dict, renamed: dict):
+    changed = set()
+    pending = [(uuid, name, db, table, row) for uuid, name in renamed.items() for db, table, row in players_by_uuid[uuid]]
+    # Name may be freed by another rename of same batch, retry while progressing
+    while len(pending) > 0:
+        conflicts = []
+        for uuid, name, db, table, row in pending:
+            # Row might be removed while job was waiting
+            if row not in table or row['ign'] == name:
+                continue
+            old_name = row['ign']
+            try:
+                table.update(row, {'ign': name})
+            except UniqueConstraintError:
+                conflicts.append((uuid, name, db, table, row))
+                continue
+            log.info(f"Player {old_name} ({uuid}) renamed to {name}, updated {db.name}.{table.name}")
+            changed.add(db.name)
+        if len(conflicts) == len(pending):
+            for uuid, name, db, table, _ in conflicts:
+                log.warn(f"Can't rename player {uuid} to {name} in {db.name}.{table.name}, name is taken")
+            break
+        pending = conflicts
+    return changed
+
+async def reconcile_igns(client: bot.DiscordBot):
+    period = config_path("manager.reconcile.period", 6 * 3600)
+    batch_size = config_path("manager.reconcile.batch", 10)
+
+    while True:
+        changed = set()
+        try:
+            await reconcile_pass(client, period, batch_size, changed)
+        except Exception as e:
+            # Task is not awaited by anyone, keep it running
+            log.error(f'Ign reconcile pass failed: {e!r}')
+            await asyncio.sleep(period)
+
+        # Single sync per pass, renames applied before failure included
+        if changed:
+            await trigger_sync(whitelist=DB.persist.name in changed, ranks=DB.ranks.name in changed)
+
+async def reconcile_pass(client: bot.DiscordBot, period: float, batch_size: int, changed: set):
+    """ Check current names of stored players, names of changed dbs are added to changed """
+    players_by_uuid = collect_stored_players()
+    uuids = list(players_by_uuid)
+    batches = [uuids[i:i + batch_size] for i in range(0, len(uuids), batch_size)]
+    # Spread lookups over whole period
+    delay = period / max(1, len(batches))
+
+    for batch in batches:
+        await asyncio.sleep(delay)
+        results = await asyncio.gather(*[mojang.lookup_uuid(uuid) for uuid in batch], return_exceptions=True)
+        renamed = {}
+        for uuid, player in zip(batch, results):
+            if isinstance(player, MojangUnavailableError):
+                log.warn(f'Failed to check current name of {uuid}: {player}')
+            elif isinstance(player, Exception):
+                log.error(f'Failed to check current name of {uuid}: {player!r}')
+            elif isinstance(player, BaseException):
+                raise player
+            elif player.valid:
+                renamed[uuid] = player.username
+        async with client.mtx:
+            changed |= apply_renames(players_by_uuid, renamed)
+
+    if len(batches) == 0:
+        await asyncio.sleep(period)
+
+def start_reconcile_igns(client: bot.DiscordBot):
+    global reconcile_task
+    if not config_path("manager.reconcile.enabled", False):
+        return
+    if reconcile_task is None or reconcile_task.done():
+        reconcile_task = asyncio.create_task(reconcile_igns(client))
+
+########################
+# Unverified Profiles  #
+########################
+
+unverified_task = None
+
+def unverified_profiles():
+    return [p for p in DB.dynamic.invalid if p.lookup_error is not None]
+
+async def retry_unverified_profiles(client: bot.DiscordBot):
+    delay = config_path("manager.profile.unverified.retry", 60)
+    max_delay = config_path("manager.profile.unverified.max_retry", 3600)
+
+    while len(unverified_profiles()) > 0:
+        await asyncio.sleep(delay)
+        profiles = unverified_profiles()
+        for profile in profiles:
+            await lookup_profile_player(profile)
+        checked = [p for p in profiles if p.lookup_error is None]
+
+        async with client.mtx:
+            for profile in checked:
+                # Profile might be edited, removed or reloaded meanwhile
+                if DB.dynamic.invalid.msg_id.get(profile.msg_id) is not profile:
+                    continue
+                log.info(f"Ign in {profile.author_name}'s profile checked on retry")
+                DB.remove_dynamic(profile.msg_id)
+                profile.error = None
+                try:
+                    await route_profile(client, profile)
+                except Exception as e:
+                    log.error(f"Failed to handle {profile.author_name}'s profile: {e!r}")
+
+        if len(checked) > 0:
+            schedule_profile_snapshot()
+            whitelist_sync.trigger()
+        # Mojang still unavailable, back off
+        if len(checked) < len(profiles):
+            delay = min(delay * 2, max_delay)
+
+def start_unverified_retry(client: bot.DiscordBot):
+    global unverified_task
+    if unverified_task is None or unverified_task.done():
+        unverified_task = asyncio.ensure_future(retry_unverified_profiles(client))
 
-    converted_entries = [entrie_conv(entries[ign]) for ign in entries]
-    formated_entries = [entrie_format.format(**e) for e in converted_entries]
+####################
+# Profile Snapshot #
+####################
 
-    return '\n'.join(formated_entries)
+# Newest profile message handled so far
+last_profile_id = None
+snapshot_handle = None
 
-def build_ftbu_ranks_data2():
-    entries = {}
+def message_edited_at(message: discord.Message):
+    return message.edited_at.timestamp() if message.edited_at is not None else None
 
-    for table in DB.ranks:
-        for row in table:
-            ign = row['ign']
-            if ign in entries:
-                entries[ign]['ranks'].append(table.name)
-            else:
-                entries[ign] = {
-                    'ign': row['ign'],
-                    'ranks': [table.name]
-                }
-    
-    entrie_format = '{ign}: {ranks}\n'
-    entrie_conv = lambda e: {'ign': e['ign'], 'ranks': ', '.join(e['ranks'])}
+def track_profile_message(message_id: int):
+    global last_profile_id
+    if last_profile_id is None or message_id > last_profile_id:
+        last_profile_id = message_id
 
-    converted_entries = [entrie_conv(entries[ign]) for ign in entries]
-    formated_entries = [entrie_format.format(**e) for e in converted_entries]
+def schedule_profile_snapshot():
+    global snapshot_handle
+    if config_path("manager.profile.snapshot.path", None) is None or snapshot_handle is not None:
+        return
+    delay = config_path("manager.profile.snapshot.delay", 10)
+    snapshot_handle = asyncio.get_event_loop().call_later(delay, lambda: asyncio.ensure_future(save_profile_snapshot()))
+
+async def save_profile_snapshot():
+    global snapshot_handle
+    snapshot_handle = None
+    path = config_path("manager.profile.snapshot.path", None)
+    if path is None or last_profile_id is None:
+        return
+    snapshot = {
+        'last_id': last_profile_id,
+        'tables': {table.name: [p.dump() for p in table] for table in DB.dynamic}
+    }
+    await asyncio.get_event_loop().run_in_executor(None, write_json, path, snapshot)
 
-    return '\n'.join(formated_entries)
+async def restore_profile_snapshot(client: bot.DiscordBot, channel: discord.TextChannel, member_cache: dict, members_loaded: bool):
+    """
+    Fill dynamic db from snapshot and check recent messages for changes made offline
 
+    Users absent in member cache are taken as departed only if member list
+    is complete, otherwise membership is confirmed by fetching them.
 
-def ptero_ftbutilities_rank_sync(srv_id):
+    Returns id of newest profile message in snapshot or None if there is no snapshot
+    """
+    global last_profile_id
+    path = config_path("manager.profile.snapshot.path", None)
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            snapshot = json.load(f)
+    except json.decoder.JSONDecodeError:
+        log.error(f'Failed to load profile snapshot {path}, replaying whole channel')
+        return None
 
-    # Dump players.txt
-    tmp_file_name = "player_ftbu_ranks.txt"
-    with open(tmp_file_name, "w") as f:
-        f.write(build_ftbu_ranks_data())
-    
-    # Upload players.txt
-    if config_path("manager.rank.upload", False):
-        ptero_sftp_upload(srv_id, tmp_file_name, "/local/ftbutilities/players.txt")
+    restored = []
+    for table_name, profiles in snapshot['tables'].items():
+        table = DB.dynamic[table_name]
+        for data in profiles:
+            profile = ProfileRecord.load(data)
+            table.add(profile)
+            restored.append(profile)
+    last_profile_id = snapshot['last_id']
+
+    # Incomplete member list, absent users might still be members
+    if not members_loaded:
+        absent = {p.author_id for p in restored if p.author_member and p.author_id not in member_cache}
+        if len(absent) > 0:
+            log.info(f'Confirming membership of {len(absent)} users')
+            for user_id, member in (await fetch_members(client, list(absent))).items():
+                if member is not None:
+                    member_cache[user_id] = member
+
+    # Profiles of users who joined or left meanwhile are handled again
+    outdated = []
+    for profile in restored:
+        is_member = isinstance(member_cache.get(profile.author_id), discord.Member)
+        if is_member != profile.author_member or profile.lookup_error is not None:
+            profile.author_member = is_member
+            outdated.append(profile)
+
+    # Bounded verification of newest snapshot messages
+    verify_limit = config_path("manager.profile.snapshot.verify", 100)
+    stored = {p.msg_id: p for t in DB.dynamic for p in t}
+    seen = set()
+    edited = []
+    oldest_id = None
+    async for message in channel.history(limit=verify_limit, before=discord.Object(last_profile_id + 1)):
+        seen.add(message.id)
+        oldest_id = message.id
+        if message.id in stored and message_edited_at(message) != stored[message.id].edited_at:
+            edited.append(message)
+    # Whole channel checked if history ended before limit
+    if len(seen) < verify_limit:
+        oldest_id = 0
+
+    for msg_id in stored:
+        if oldest_id is not None and msg_id >= oldest_id and msg_id not in seen:
+            log.info(f'Profile {msg_id} was deleted while offline')
+            DB.remove_dynamic(msg_id)
+
+    for profile in outdated:
+        if DB.remove_dynamic(profile.msg_id) is None:
+            continue
+        profile.error = None
+        if profile.lookup_error is not None:
+            await lookup_profile_player(profile)
+        await route_profile(client, profile)
 
-    # Dump player_ranks.txt
-    tmp_file_name = "player_ranks.txt"
-    with open(tmp_file_name, "w") as f:
-        f.write(build_ftbu_ranks_data2())
-    
-    # Upload players.txt
-    if config_path("manager.rank.upload", False):
-        ptero_sftp_upload(srv_id, tmp_file_name, "/local/ftbutilities/player_ranks.txt")
+    for message in edited:
+        DB.remove_dynamic(message.id)
+        await handle_history_message(client, message, member_cache)
 
-def ptero_spigot_rank_sync(srv_id):
-    pass
+    log.info(f'Restored {len(stored)} profiles from snapshot, {len(outdated) + len(edited)} changed')
+    return last_profile_id
 
 ####################
 # Profile Handlers #
 ####################
 
 async def handle_profile_message(client: bot.DiscordBot, message: discord.Message):
-    profile = parse_dynamic_profile(message)
+    profile = await parse_dynamic_profile(message)
+    await handle_profile(client, profile, message)
+
+async def route_profile(client: bot.DiscordBot, profile: ProfileRecord, message: discord.Message = None):
+    # Handle profile as deprecated if user left server
+    if not profile.author_member:
+        log.info(f'Deprecated {profile.author_name}\'s profile detected: {dumps_dynamic_profile(profile)}')
+        if config_path("manager.profile.deprecated.delete", False):
+            await delete_profile_message(client, profile, message)
+        else:
+            await handle_deprecated_profile(client, profile, message)
+        return
+
+    # Handle profile from member
+    await handle_profile(client, profile, message)
+
+async def handle_profile(client: bot.DiscordBot, profile: ProfileRecord, message: discord.Message = None):
+    # Handle profile which ign could not be checked
+    if profile.lookup_error is not None:
+        handle_unverified_profile(client, profile)
+        return
 
     # Handle invalid profile
     if not is_full_profile(profile):
-        if is_admin_message(message):
-            log.info(f'Ignoring message from {message.author.name} as admin\'s message: {json.dumps(message.content)}')
+        if is_admin_profile(client, profile, message):
+            log.info(f'Ignoring message from {profile.author_name} as admin\'s message: {dumps_dynamic_profile(profile)}')
         else:
-            await handle_invalid_profile(client, message, profile)
+            await handle_invalid_profile(client, profile, message)
         return
-    elif not profile['player'].valid:
-        await handle_invalid_profile(client, message, profile)
+    elif not profile.valid:
+        await handle_invalid_profile(client, profile, message)
         return
 
     # Search for profile with same ign
-    existing_profile = DB.find_dynamic_whitelisted(profile['ign'])
+    existing_profile = DB.find_dynamic_whitelisted(profile.ign)
 
     # Handle user trying to add profile with duplicate ign
     if existing_profile is not None:
-        if is_same_author(existing_profile['msg'], message):
+        if existing_profile.author_id == profile.author_id:
             await handle_profile_update(client, existing_profile, profile)
         else:
-            await handle_duplicate_profile_ign(client, existing_profile, profile)
+            await handle_duplicate_profile_ign(client, existing_profile, profile, message)
             return
     
     DB.dynamic.valid.add(profile)
 
-async def handle_deprecated_profile_message(client: bot.DiscordBot, message: discord.Message):
-    profile = parse_dynamic_profile(message)
+async def handle_deprecated_profile(client: bot.DiscordBot, profile: ProfileRecord, message: discord.Message = None):
+    # Handle profile which ign could not be checked
+    if profile.lookup_error is not None:
+        handle_unverified_profile(client, profile, deprecated=True)
+        return
 
     # Handle invalid profile
-    if not is_full_profile(profile) or not profile['player'].valid:
+    if not is_full_profile(profile) or not profile.valid:
         if config_path("manager.profile.invalid.default.delete", False):
-            await message.delete()
+            await delete_profile_message(client, profile, message)
         else:
             if not is_full_profile(profile):
                 required = get_missing_entries(profile)
                 required_str = ', '.join([str(s) for s in required])
-                profile['error'] = f"deprecated, missing entries: {required_str}"
+                profile.error = f"deprecated, missing entries: {required_str}"
             else:
-                profile['error'] = "deprecated, invalid ign"
+                profile.error = "deprecated, invalid ign"
             DB.dynamic.invalid.add(profile)
         return
 
     # Search for profile with same ign
-    existing_profile = DB.find_dynamic_whitelisted(profile['ign'])
+    existing_profile = DB.find_dynamic_whitelisted(profile.ign)
 
     # Handle user trying to add profile with duplicate ign
     if existing_profile is not None:
-        if is_same_author(existing_profile['msg'], message):
+        if existing_profile.author_id == profile.author_id:
             await handle_profile_update(client, existing_profile, profile)
         else:
-            await handle_duplicate_deprecated_profile_ign(client, existing_profile, profile)
+            await handle_duplicate_deprecated_profile_ign(client, existing_profile, profile, message)
             return
     
     DB.dynamic.deprecated.add(profile)
 
-async def handle_invalid_profile(client: bot.DiscordBot, message: discord.Message, profile: dict):
-    user = message.author
+async def handle_invalid_profile(client: bot.DiscordBot, profile: ProfileRecord, message: discord.Message = None):
+    # Users get DM only about messages they just sent
+    user = message.author if message is not None else None
 
     # Handle missing entries in profile
     if not is_full_profile(profile):
-        log.info(f"Invalid profile by {user.name}: {dumps_dynamic_profile(profile)}")
+        log.info(f"Invalid profile by {profile.author_name}: {dumps_dynamic_profile(profile)}")
         if config_path("manager.profile.invalid.default.delete", False):
-            await message.delete()
+            await delete_profile_message(client, profile, message)
         else:
             required = get_missing_entries(profile)
             required_str = ', '.join([str(s) for s in required])
-            profile['error'] = f"missing entries: {required_str}"
+            profile.error = f"missing entries: {required_str}"
             DB.dynamic.invalid.add(profile)
-        if config_path("manager.profile.invalid.default.dm", False):
+        if user is not None and config_path("manager.profile.invalid.default.dm", False):
             await user.send(INVALID_PROFILE_DM_MSG.format(user.name, quote_msg(message.content)))
     # Handle invalid ign
-    elif not profile['player'].valid:
-        log.info(f"Invalid ign by {user.name}: {dumps_dynamic_profile(profile)}")
+    elif not profile.valid:
+        log.info(f"Invalid ign by {profile.author_name}: {dumps_dynamic_profile(profile)}")
         if config_path("manager.profile.invalid.ign.delete", False):
-            await message.delete()
+            await delete_profile_message(client, profile, message)
         else:
-            profile['error'] = "invalid ign"
+            profile.error = "invalid ign"
             DB.dynamic.invalid.add(profile)
-        if config_path("manager.profile.invalid.ign.dm", False):
+        if user is not None and config_path("manager.profile.invalid.ign.dm", False):
             await user.send(INVALID_PROFILE_IGN_DM_MSG.format(user.name, quote_msg(message.content)))
     # Handle unknown profile error
     else:
-        raise RuntimeError(f"Something went wrong cheking {user.name}'s profile: {dumps_dynamic_profile(profile)}")
-
-async def handle_profile_update(client: bot.DiscordBot, old_profile: dict, profile: dict):
-    log.info(f"{profile['msg'].author.name}'s profile update detected {dumps_dynamic_profile(old_profile)} -> {dumps_dynamic_profile(profile)}")
-    DB.remove_dynamic(old_profile['msg_id'])
-    if old_profile['msg'].id != profile['msg'].id:
+        raise RuntimeError(f"Something went wrong cheking {profile.author_name}'s profile: {dumps_dynamic_profile(profile)}")
+
+def handle_unverified_profile(client: bot.DiscordBot, profile: ProfileRecord, deprecated=False):
+    # Never reject profile because of Mojang API failure, keep it until lookup is retried
+    log.warn(f"Failed to check ign in {profile.author_name}'s profile ({profile.lookup_error}): {dumps_dynamic_profile(profile)}")
+    profile.error = "deprecated, ign not checked yet" if deprecated else "ign not checked yet"
+    DB.dynamic.invalid.add(profile)
+    start_unverified_retry(client)
+
+async def handle_profile_update(client: bot.DiscordBot, old_profile: ProfileRecord, profile: ProfileRecord):
+    log.info(f"{profile.author_name}'s profile update detected {dumps_dynamic_profile(old_profile)} -> {dumps_dynamic_profile(profile)}")
+    DB.remove_dynamic(old_profile.msg_id)
+    if old_profile.msg_id != profile.msg_id:
         if config_path("manager.profile.update.old.delete", False):
             try:
-                await old_profile['msg'].delete()
+                await delete_profile_message(client, old_profile)
             except discord.errors.NotFound:
                 pass
         else:
-            old_profile['error'] = "old profile"
+            old_profile.error = "old profile"
             DB.dynamic.invalid.add(old_profile)
 
-async def handle_duplicate_profile_ign(client: bot.DiscordBot, or_profile: dict, profile: dict):
-    message = profile['msg']
-    user = message.author
-    or_user = or_profile['msg'].author
-    log.warn(f"Duplicate ign detected in {user.name}'s profile: {dumps_dynamic_profile(profile)}, original profile from {or_user.name}: {dumps_dynamic_profile(or_profile)}")
+async def handle_duplicate_profile_ign(client: bot.DiscordBot, or_profile: ProfileRecord, profile: ProfileRecord, message: discord.Message = None):
+    log.warn(f"Duplicate ign detected in {profile.author_name}'s profile: {dumps_dynamic_profile(profile)}, original profile from {or_profile.author_name}: {dumps_dynamic_profile(or_profile)}")
     if config_path("manager.profile.invalid.duplicate.delete", False):
-        await message.delete()
+        await delete_profile_message(client, profile, message)
     else:
-        profile['error'] = "duplicate ign"
+        profile.error = "duplicate ign"
         DB.dynamic.invalid.add(profile)
-    if config_path("manager.profile.invalid.duplicate.dm", False):
+    if message is not None and config_path("manager.profile.invalid.duplicate.dm", False):
+        user = message.author
         await user.send(FOREIGN_PROFILE_DM_MSG.format(user.name, quote_msg(message.content)))
 
-async def handle_duplicate_deprecated_profile_ign(client: bot.DiscordBot, or_profile: dict, profile: dict):
-    message = profile['msg']
-    user = message.author
-    or_user = or_profile['msg'].author
-    log.warn(f"Duplicate ign detected in deprecated {user.name}'s profile: {dumps_dynamic_profile(profile)}, original profile from {or_user.name}: {dumps_dynamic_profile(or_profile)}")
+async def handle_duplicate_deprecated_profile_ign(client: bot.DiscordBot, or_profile: ProfileRecord, profile: ProfileRecord, message: discord.Message = None):
+    log.warn(f"Duplicate ign detected in deprecated {profile.author_name}'s profile: {dumps_dynamic_profile(profile)}, original profile from {or_profile.author_name}: {dumps_dynamic_profile(or_profile)}")
     if config_path("manager.profile.invalid.duplicate.delete", False):
-        await message.delete()
+        await delete_profile_message(client, profile, message)
     else:
-        profile['error'] = "duplicate ign"
+        profile.error = "duplicate ign"
         DB.dynamic.invalid.add(profile)
 
 ##################
 # Event Handlers #
 ##################
 
-async def init(client: bot.DiscordBot):
+async def load_guild_members(client: bot.DiscordBot, member_cache: dict):
+    """
+    Fill member cache from guild member list, chunked over gateway once
+
+    Returns True if member list is complete, so absent users are not members
+    """
+    guild = client.guild
+    if not guild.chunked:
+        try:
+            await asyncio.wait_for(guild.chunk(), config_path("manager.members.chunk_timeout", 60))
+        except (discord.errors.ClientException, asyncio.TimeoutError) as e:
+            log.warn(f'Failed to load guild members, fetching them one by one: {e!r}')
+    for member in guild.members:
+        member_cache[member.id] = member
+    log.info(f'Loaded {len(guild.members)} guild members')
+    return guild.chunked
+
+async def fetch_members(client: bot.DiscordBot, user_ids: list):
+    """ Fetch members concurrently, returns user id -> member or None if not a member """
+    semaphore = asyncio.Semaphore(config_path("manager.members.concurrency", 8))
+
+    async def fetch(user_id):
+        async with semaphore:
+            try:
+                return await client.guild.fetch_member(user_id)
+            except discord.errors.NotFound:
+                return None
+
+    members = await asyncio.gather(*[fetch(user_id) for user_id in user_ids])
+    return dict(zip(user_ids, members))
+
+async def fetch_missing_members(client: bot.DiscordBot, users: list, member_cache: dict):
+    """ Fetch users absent in member cache concurrently, non-members are cached as is """
+    missing = {user.id: user for user in users if user.id not in member_cache}
+    if len(missing) > 0:
+        log.info(f'Fetching {len(missing)} members')
+        members = await fetch_members(client, list(missing))
+        for user_id, member in members.items():
+            member_cache[user_id] = member if member is not None else missing[user_id]
+
+async def handle_history_message(client: bot.DiscordBot, message: discord.Message, member_cache: dict):
+    user = message.author
+
+    # Get user-member object
+    if user.id not in member_cache:
+        try:
+            member = await client.guild.fetch_member(user.id)
+            if member is None:
+                member = user
+        except discord.errors.NotFound:
+            member = user
+        member_cache[user.id] = member
+    message.author = member_cache[user.id]
+
+    profile = await parse_dynamic_profile(message)
+    await route_profile(client, profile, message)
+
+##################
+# History Replay #
+##################
+
+class StageStats(object):
+    """
+    Item count and busy time of replay pipeline stage
+
+    Time spent waiting for other stages is not counted, busy time of
+    concurrent batches is summed.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy = 0
+
+    def __str__(self):
+        return f'{self.name}: {self.items} items, {self.busy:.2f}s busy'
+
+async def run_pipeline(stages: list):
+    """ Run stage coroutines together, first failed stage cancels the rest """
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for task in pending:
+        task.cancel()
+    for task in done:
+        task.result()
+
+async def replay_history(client: bot.DiscordBot, channel: discord.TextChannel, after, member_cache: dict, members_loaded: bool):
+    """
+    Handle profile messages posted after given one in 4 stages:
+        history - history pages are fetched ahead of processing
+        parse   - own messages are skipped, profile fields parsed
+        lookup  - authors and igns of up to BULK_LOOKUP_LIMIT messages are
+                  resolved per batch, several batches at once
+        apply   - profiles are added to db oldest first, in history order
+    """
+    queue_size = config_path("manager.history.queue", 200)
+    messages = asyncio.Queue(queue_size)
+    parsed = asyncio.Queue(queue_size)
+    ordered = asyncio.Queue(queue_size)
+    semaphore = asyncio.Semaphore(config_path("manager.history.concurrency", 4))
+    stats = {name: StageStats(name) for name in ['history', 'parse', 'lookup', 'apply']}
+
+    async def fetch_history():
+        stat = stats['history']
+        start = time.monotonic()
+        async for message in channel.history(limit=None, after=after, oldest_first=True):
+            stat.busy += time.monotonic() - start
+            stat.items += 1
+            await messages.put(message)
+            start = time.monotonic()
+        await messages.put(None)
+
+    async def parse():
+        stat = stats['parse']
+        while (message := await messages.get()) is not None:
+            # Skip own messages
+            if message.author == client.user:
+                continue
+            start = time.monotonic()
+            item = (message, parse_profile_fields(message))
+            stat.items += 1
+            stat.busy += time.monotonic() - start
+            await parsed.put(item)
+        await parsed.put(None)
+
+    async def lookup_batch(batch: list, futures: list):
+        stat = stats['lookup']
+        try:
+            async with semaphore:
+                start = time.monotonic()
+                # Authors absent in full member list have left guild
+                authors = [message.author for message, _ in batch]
+                if members_loaded:
+                    for user in authors:
+                        member_cache.setdefault(user.id, user)
+                else:
+                    await fetch_missing_members(client, authors, member_cache)
+
+                igns = [fields.get('ign', '') for _, fields in batch]
+                try:
+                    await mojang.lookup_many([ign for ign in igns if ign != ''])
+                except MojangUnavailableError as e:
+                    log.warn(f'Bulk ign lookup failed, falling back to single lookups: {e}')
+
+                for (message, fields), future in zip(batch, futures):
+                    message.author = member_cache[message.author.id]
+                    profile = ProfileRecord.from_message(message, fields)
+                    await lookup_profile_player(profile)
+                    future.set_result((message, profile))
+                stat.items += len(batch)
+                stat.busy += time.monotonic() - start
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+                    # Apply stage raises on first of them, rest are not awaited
+                    future.exception()
+
+    async def lookup():
+        loop = asyncio.get_event_loop()
+        tasks = []
+        try:
+            item = await parsed.get()
+            while item is not None:
+                # Batch is whatever is parsed already
+                batch = [item]
+                while len(batch) < BULK_LOOKUP_LIMIT and not parsed.empty():
+                    item = parsed.get_nowait()
+                    if item is None:
+                        break
+                    batch.append(item)
+                # Apply stage gets results in history order
+                futures = [loop.create_future() for _ in batch]
+                for future in futures:
+                    await ordered.put(future)
+                tasks = [task for task in tasks if not task.done()]
+                tasks.append(asyncio.ensure_future(lookup_batch(batch, futures)))
+                if item is not None:
+                    item = await parsed.get()
+            await ordered.put(None)
+            await asyncio.gather(*tasks)
+        finally:
+            # Pipeline cancelled, batches in flight are not needed
+            for task in tasks:
+                task.cancel()
+
+    async def apply():
+        stat = stats['apply']
+        while (future := await ordered.get()) is not None:
+            message, profile = await future
+            start = time.monotonic()
+            await route_profile(client, profile, message)
+            track_profile_message(message.id)
+            stat.items += 1
+            stat.busy += time.monotonic() - start
+
+    start = time.monotonic()
+    await run_pipeline([fetch_history(), parse(), lookup(), apply()])
+    log.info(f'Replayed history in {time.monotonic() - start:.2f}s (' + ', '.join(str(s) for s in stats.values()) + ')')
+
+async def init(client: bot.DiscordBot, warm=True):
+    global last_profile_id
     log.info(f'Initializing')
+    # Syncs must not run while db is being reloaded
+    whitelist_sync.lock = ranks_sync.lock = client.mtx
+
     # Lock current async context
     async with client.mtx:
         # Init db
         DB.load()
         DB.dynamic.clear()
+        last_profile_id = None
 
         # Make user-member cache
         member_cache = {}
+        members_loaded = await load_guild_members(client, member_cache)
 
         # Get profile source channel
         profile_channel = client.get_attached_sink("profile")["channel"]
-        
-        # Iterate over each profile message
-        async for message in profile_channel.history(limit=None,oldest_first=True):
-            user = message.author
 
-            # Skip own messages
-            if user == client.user:
-                continue
+        # Start from snapshot if possible
+        after = None
+        if warm and (snapshot_id := await restore_profile_snapshot(client, profile_channel, member_cache, members_loaded)) is not None:
+            after = discord.Object(snapshot_id)
+        
+        # Replay profile messages
+        await replay_history(client, profile_channel, after, member_cache, members_loaded)
 
-            # Get user-member object
-            if user.id not in member_cache:
-                try:
-                    member = await client.guild.fetch_member(user.id)
-                    if member is None:
-                        member = user
-                except discord.errors.NotFound:
-                    member = user
-                member_cache[user.id] = member
-            user = member_cache[user.id]
-            message.author = user
-
-            # Handle message as deprecated if user left server
-            if not is_user_member(user):
-                log.info(f'Deprecated {user.name}\'s profile detected: {json.dumps(message.content)}')
-                if config_path("manager.profile.deprecated.delete", False):
-                    await message.delete()
-                else:
-                    await handle_deprecated_profile_message(client, message)
-                continue
-            
-            # Handle profile message from member
-            await handle_profile_message(client, message)
+        log.info(f'Player cache: {players.hits} hits, {players.misses} misses')
+        schedule_profile_snapshot()
         
         # Sync whitelist/ranking state
-        sync_whitelist()
-        sync_ranks()
+        whitelist_sync.trigger()
+        ranks_sync.trigger()
+
+    start_reconcile_igns(client)
+    inventory.start()
+
+async def close(client: bot.DiscordBot):
+    log.info(f'Shutting down')
+    await DB.flush()
+    await save_players()
+    await mojang.close()
 
 async def new_profile(client: bot.DiscordBot, message: discord.Message):
     log.info(f'New profile detected')
     await handle_profile_message(client, message)
-    sync_whitelist()
+    track_profile_message(message.id)
+    schedule_profile_snapshot()
+    whitelist_sync.trigger()
 
 async def edit_profile(client: bot.DiscordBot, msg: discord.Message):
     log.info(f'Profile edit detected')
+    # Edited message replaces its previous state
+    DB.remove_dynamic(msg.id)
     await handle_profile_message(client, msg)
-    sync_whitelist()
+    schedule_profile_snapshot()
+    whitelist_sync.trigger()
 
 async def delete_profile(client: bot.DiscordBot, msg_id: int):
     log.info(f'Profile remove detected')
     profile = DB.remove_dynamic(msg_id)
     if profile is not None:
         log.info(f'Profile deleted: {profile}')
-        sync_whitelist()
+        schedule_profile_snapshot()
+        whitelist_sync.trigger()
 
 async def user_left(client: bot.DiscordBot, member: discord.Member):
     log.warn(f"User {member.name} left server, moving profiles")
     deleted_profiles = DB.remove_all_by_user(member)
-    if config_path("manager.profile.deprecated.delete", False):
-        for profile in deleted_profiles:
-            await profile['msg'].delete()
-    else:
-        for profile in deleted_profiles:
-            await handle_deprecated_profile_message(client, profile['msg'])
+    for profile in deleted_profiles:
+        profile.author_member = False
+        profile.error = None
+        await route_profile(client, profile)
+    schedule_profile_snapshot()
+    whitelist_sync.trigger()
 
 ############################
 # Control command Handlers #
@@ -619,25 +1837,28 @@ async def add_persist_profile(client: bot.DiscordBot, mgs_obj: discord.Message,
     table = DB.persist.root
 
     # Parse profile
-    profile = make_persist_profile(mgs_obj, ign)
+    try:
+        profile = await make_persist_profile(mgs_obj, ign)
+    except MojangUnavailableError:
+        await mgs_obj.channel.send(f"Mojang API is unavailable, try again later")
+        return
     if profile is None:
         await mgs_obj.channel.send(f"Invalid ign")
         return
     
     # Handle already existing persist profile
     if ign in table.ign:
-        or_profile = table.ign[ign][0]
+        or_profile = table.ign[ign]
         await mgs_obj.channel.send(f"This ign is already added by <@{or_profile['author']}>")
         return
     
     # Handle already existing dynamic profile
     existing_profile = DB.find_dynamic_whitelisted(ign)
     if existing_profile is not None:
-        or_msg = existing_profile['msg']
-        await mgs_obj.channel.send(f"Note: profile with specified ign is exists (by {or_msg.author.mention})")
+        await mgs_obj.channel.send(f"Note: profile with specified ign is exists (by {existing_profile.mention})")
 
     table.add(profile)
-    sync_whitelist()
+    await whitelist_sync.trigger()
     await mgs_obj.channel.send(f"Added successfully")
 
 @cmdcoro
@@ -647,29 +1868,59 @@ async def remove_persist_profile(client: bot.DiscordBot, mgs_obj: discord.Messag
     if ign not in table.ign:
         await mgs_obj.channel.send(f"Specified ign not added yet")
         return
-    profile = table.ign[ign][0]
+    profile = table.ign[ign]
     
     # Handle already existing dynamic profile
     existing_profile = DB.find_dynamic_whitelisted(ign)
     if existing_profile is not None:
-        or_msg = existing_profile['msg']
-        await mgs_obj.channel.send(f"Note: profile with specified ign is exists (by {or_msg.author.mention})")
+        await mgs_obj.channel.send(f"Note: profile with specified ign is exists (by {existing_profile.mention})")
     
     table.remove(profile)
-    sync_whitelist()
+    await whitelist_sync.trigger()
     await mgs_obj.channel.send(f"Removed successfully")
 
 @cmdcoro
 async def reload(client: bot.DiscordBot, mgs_obj: discord.Message):
     await mgs_obj.channel.send(f"Reloading")
-    await init(client)
+    # Full channel replay, snapshot is rebuilt
+    await init(client, warm=False)
     await mgs_obj.channel.send(f"Reloaded data successfully")
 
 @cmdcoro
-async def sync(client: bot.DiscordBot, mgs_obj: discord.Message):
-    await mgs_obj.channel.send(f"Syncing whitelist")
-    sync_whitelist()
-    await mgs_obj.channel.send(f"Synced successfully")
+async def sync(client: bot.DiscordBot, mgs_obj: discord.Message, force: str = None):
+    if force not in (None, '--force'):
+        await mgs_obj.channel.send('Usage: ' + build_cmdcoro_usage('sync', sync.or_cmdcoro))
+        return
+    force = force is not None
+    await mgs_obj.channel.send(f"Syncing whitelist and ranks")
+    results = await asyncio.gather(whitelist_sync.trigger(force), ranks_sync.trigger(force))
+    report = '\n'.join(format_deploy_results(name, r) for name, r in zip(['whitelist', 'ranks'], results))
+    failed = any(r.status == 'failed' for r in results[0] + results[1])
+    status = "Sync finished with failures" if failed else "Synced successfully"
+    await mgs_obj.channel.send(f"{status}\n`{report}`")
+
+@cmdcoro
+async def show_servers(client: bot.DiscordBot, mgs_obj: discord.Message):
+    servers = await inventory.get()
+    whitelist_servers = config_path("manager.whitelist.servers", [])
+    rank_systems = config_path("manager.rank.servers", {})
+
+    lines = []
+    for srv_id, server in servers.items():
+        targets = []
+        if srv_id in whitelist_servers:
+            targets.append('whitelist')
+        if srv_id in rank_systems:
+            targets.append(f'ranks ({rank_systems[srv_id]})')
+        targets_str = ', '.join(targets) if len(targets) > 0 else 'not managed'
+        lines.append(f'[{srv_id}] {server.get("name", "")}: {targets_str}')
+
+    age = inventory.age()
+    age_str = 'never' if age is None else f'{age:.0f}s ago'
+    msg = f'{len(servers)} servers, updated {age_str}'
+    if len(lines) > 0:
+        msg += '\n`' + '\n'.join(lines).replace('`', '\'') + '`'
+    await mgs_obj.channel.send(msg)
 
 @cmdcoro
 async def get_profile(client: bot.DiscordBot, mgs_obj: discord.Message, name: str):
@@ -677,35 +1928,31 @@ async def get_profile(client: bot.DiscordBot, mgs_obj: discord.Message, name: st
 
     await mgs_obj.channel.send("##### SEARCH START #####")
 
-    for table in DB.dynamic:
-        for profile in table:
-            ign = profile['ign']
-            user = profile['msg'].author
-
-            if user.name == name or user.name + user.discriminator == name or f'{user.name}#{user.discriminator}' == name:
-                row_str = f'Found {user.mention}\'s dynamic profile (same name)\n' + convert(profile)
-            elif user.mention == name:
-                row_str = f'Found {user.mention}\'s dynamic profile (by mentioning)\n' + convert(profile)
-            elif user.display_name == name:
-                row_str = f'Found {user.mention}\'s dynamic profile (same display name)\n' + convert(profile)
-            elif ign == name:
-                row_str = f'Found {user.mention}\'s dynamic profile (same ign)\n' + convert(profile)
-            else:
-                continue
-
-            await mgs_obj.channel.send(row_str)
-
-    for profile in DB.persist.root:
-        ign = profile['ign']
-        user_id = profile['author']
-
-        if ign == name:
-            row_str = f'Found <@{user_id}>\'s persist profile\n' + convert(profile)
-        else:
-            continue
-
+    # (table, id) -> (profile, match reason), first reason wins
+    found = {}
+    def collect(reason, **predicates):
+        for table, profile in DB.dynamic.find(**predicates):
+            found.setdefault((table.name, profile.id), (profile, reason))
+
+    collect('same name', author_name=name)
+    if (tag := re.match(r'^(.+?)#?(\d{4})$', name)) is not None:
+        collect('same name', author_tag=f'{tag[1]}#{tag[2]}')
+    if (mention := re.match(r'^<@!?(\d+)>$', name)) is not None:
+        collect('by mentioning', author_id=int(mention[1]))
+    collect('same display name', display_name=name)
+    collect('same ign', ign=name)
+
+    # Keep table order
+    table_order = {table.name: i for i, table in enumerate(DB.dynamic)}
+    for key in sorted(found, key=lambda k: (table_order[k[0]], k[1])):
+        profile, reason = found[key]
+        row_str = f'Found {profile.mention}\'s dynamic profile ({reason})\n' + convert(profile)
         await mgs_obj.channel.send(row_str)
 
+    profile = DB.persist.root.ign.get(name)
+    if profile is not None:
+        row_str = f'Found <@{profile["author"]}>\'s persist profile\n' + '`' + dumps_presist_profile(profile, pretty=True).replace('`', '\'') + '`'
+        await mgs_obj.channel.send(row_str)
 
     await mgs_obj.channel.send("##### SEARCH END #####")
 
@@ -719,14 +1966,14 @@ async def add_rank(client: bot.DiscordBot, mgs_obj: discord.Message, ign: str, r
     
     # Handle already ranked profile
     if ign in table.ign:
-        or_profile = table.ign[ign][0]
+        or_profile = table.ign[ign]
         await mgs_obj.channel.send(f"This ign is already ranked as {rank} by <@{or_profile['author']}>")
         return
 
     # Find and convert profile
     profile = DB.find_dynamic_whitelisted(ign)
     if profile is None:
-        profile = persist_profile_to_whitelist_row(DB.persist.root.ign[ign][0]) \
+        profile = persist_profile_to_whitelist_row(DB.persist.root.ign[ign]) \
                     if ign in DB.persist.root.ign else None
     else:
         profile = dynamic_profile_to_whitelist_row(profile)
@@ -736,8 +1983,8 @@ async def add_rank(client: bot.DiscordBot, mgs_obj: discord.Message, ign: str, r
         await mgs_obj.channel.send(f"No profile found for specified ign")
         return
 
-    table.add({'ign': ign, 'author': mgs_obj.author.id, 'uuid': profile['uuid']})
-    sync_ranks()
+    table.add({'ign': profile['name'], 'author': mgs_obj.author.id, 'uuid': profile['uuid']})
+    await ranks_sync.trigger()
     await mgs_obj.channel.send(f"Ranked {ign} as {rank} successfully")
 
 @cmdcoro
@@ -751,10 +1998,10 @@ async def remove_rank(client: bot.DiscordBot, mgs_obj: discord.Message, ign: str
     if ign not in table.ign:
         await mgs_obj.channel.send(f"Specified ign not ranked as {rank} yet")
         return
-    profile = table.ign[ign][0]
+    profile = table.ign[ign]
     
     table.remove(profile)
-    sync_ranks()
+    await ranks_sync.trigger()
     await mgs_obj.channel.send(f"Removed rank {rank} from {ign} successfully")
 
 @cmdcoro
@@ -763,13 +2010,8 @@ async def get_rank(client: bot.DiscordBot, mgs_obj: discord.Message, ign: str):
     if ign not in DB.persist.root.ign and DB.find_dynamic_whitelisted(ign) is None:
         await mgs_obj.channel.send(f"No profile found for specified ign")
         return
-    ranks = []
     # Gather ranks
-    for table in DB.ranks:
-        if ign not in table.ign:
-            continue
-        ranked_by = table.ign[ign][0]['author']
-        ranks.append(f'{table.name} (ranked by <@{ranked_by}>)')
+    ranks = [f'{rank} (ranked by <@{row["author"]}>)' for rank, row in rank_renderer.get(ign).items()]
     # Handle no ranks
     if len(ranks) == 0:
         await mgs_obj.channel.send(f"No ranks found for {ign}")
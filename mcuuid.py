@@ -20,8 +20,22 @@ Uses the official Mojang API to fetch player data.
 ### Import necessary modules
 import http.client
 import json
+import os
+import time
+import asyncio
+import aiohttp
+from collections import OrderedDict
 from uuid import UUID
 
+class MojangUnavailableError(Exception):
+    """
+        Mojang API failed to answer (rate limit, server error, timeout).
+        Unlike a missing player it says nothing about the identifier.
+    """
+
+    def __init__(self, msg):
+        super().__init__(f'Mojang API unavailable: {msg}')
+
 def is_valid_minecraft_username(username):
     """https://help.mojang.com/customer/portal/articles/928638-minecraft-usernames"""
     allowed_chars = 'abcdefghijklmnopqrstuvwxyz1234567890_'
@@ -89,10 +103,15 @@ class GetPlayerData:
             http_conn = http.client.HTTPSConnection("api.mojang.com");
             http_conn.request("GET", req,
                 headers={'User-Agent':'https://github.com/clerie/mcuuid', 'Content-Type':'application/json'});
-            response = http_conn.getresponse().read().decode("utf-8")
+            http_response = http_conn.getresponse()
+            response = http_response.read().decode("utf-8")
+
+            # Rate limit or server failure, player may exist
+            if http_response.status not in (200, 204, 404):
+                raise MojangUnavailableError(f'HTTP {http_response.status}')
 
             # In case the answer is empty, the user dont exist
-            if not response:
+            if not response or http_response.status != 200:
                 self.valid = False
             # If there is an answer, fill out the variables
             else:
@@ -130,3 +149,365 @@ class GetPlayerData:
                     # The username written correctly
                     self.username = current_name
                 self.uuid = UUID(self.uuid)
+
+### Bulk lookup
+BULK_LOOKUP_LIMIT = 10
+
+### Lookup cache
+class PlayerData:
+    """
+        Player data restored from cache, same shape as GetPlayerData
+    """
+    def __init__(self, uuid=None, username=None, valid=True):
+        self.valid = valid
+        if valid:
+            self.uuid = uuid
+            self.username = username
+
+class PlayerCache:
+    """
+        Disk-backed LRU cache of username lookups
+
+        Parameters
+        ----------
+        path: string (optional)
+            File the cache is persisted to, memory only if None
+        ttl: integer
+            Seconds a found player is kept
+        negative_ttl: integer
+            Seconds a missing player is kept
+        size: integer
+            Maximum number of cached usernames
+    """
+    def __init__(self, path=None, ttl=86400, negative_ttl=3600, size=10000):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        # lowercase username -> [uuid hex or None, username, valid, expiration time]
+        self.entries = OrderedDict()
+        # uuid hex -> lowercase username of latest entry
+        self.uuids = {}
+        self.load()
+
+    def get(self, username):
+        key = username.lower()
+        entry = self.entries.get(key)
+        if entry is None or entry[3] < time.time():
+            if entry is not None:
+                del self.entries[key]
+                self.dirty = True
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        uuid = UUID(entry[0]) if entry[2] else None
+        return PlayerData(uuid, entry[1], entry[2])
+
+    def get_by_uuid(self, uuid):
+        key = self.uuids.get(uuid.hex)
+        entry = self.entries.get(key) if key is not None else None
+        if entry is None or entry[0] != uuid.hex or entry[3] < time.time():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return PlayerData(uuid, entry[1], True)
+
+    def put(self, username, player):
+        key = username.lower()
+        if player.valid:
+            entry = [player.uuid.hex, player.username, True, time.time() + self.ttl]
+            self.uuids[player.uuid.hex] = key
+        else:
+            entry = [None, username, False, time.time() + self.negative_ttl]
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.__forget(*self.entries.popitem(last=False))
+        self.dirty = True
+
+    def __forget(self, key, entry):
+        if entry[0] is not None and self.uuids.get(entry[0]) == key:
+            del self.uuids[entry[0]]
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except json.decoder.JSONDecodeError:
+            return
+        now = time.time()
+        self.entries = OrderedDict((k, e) for k, e in entries if e[3] >= now)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        self.uuids = {e[0]: k for k, e in self.entries.items() if e[0] is not None}
+        self.dirty = False
+
+    def dump(self):
+        """ Serialized entries if changed since last dump, otherwise None """
+        if not self.dirty:
+            return None
+        self.dirty = False
+        return json.dumps(list(self.entries.items()))
+
+### Async client
+class TokenBucket:
+    """
+        Asyncio token bucket shaping outgoing requests
+
+        Parameters
+        ----------
+        rate: float
+            Tokens added per second
+        capacity: integer
+            Maximum burst size
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def pause(self, delay):
+        """ Stop handing out tokens for delay seconds (e.g. on 429) """
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class MojangClient:
+    """
+        Asyncio Mojang API client
+
+        Keeps a pool of keep-alive connections to api.mojang.com, limits
+        the number of simultaneous requests and shapes them with a token
+        bucket. Identical lookups in flight share one request. Rate limit
+        answers and server failures are retried with backoff and finally
+        raise MojangUnavailableError, they never mark a player as missing.
+
+        Parameters
+        ----------
+        cache: PlayerCache (optional)
+            Cache consulted before any request
+        timeout: float
+            Seconds a single request may take
+        concurrency: integer
+            Maximum number of simultaneous requests
+        rate: float
+            Requests per second allowed on average
+        burst: integer
+            Requests allowed at once after idling
+        retries: integer
+            Attempts made before giving up on a request
+        backoff: float
+            First retry delay in seconds, doubled on each attempt
+    """
+    API_URL = "https://api.mojang.com"
+    SESSION_URL = "https://sessionserver.mojang.com"
+    HEADERS = {'User-Agent':'https://github.com/clerie/mcuuid', 'Content-Type':'application/json'}
+
+    def __init__(self, cache=None, timeout=10, concurrency=4, rate=5, burst=10, retries=5, backoff=1):
+        self.cache = cache
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate, burst)
+        # lowercase username -> future of PlayerData
+        self._inflight = {}
+        # Created lazily inside running loop
+        self._session = None
+        self._semaphore = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.HEADERS)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    def _retry_delay(self, response, attempt):
+        delay = self.backoff * 2 ** attempt
+        if response is not None and 'Retry-After' in response.headers:
+            try:
+                delay = max(delay, float(response.headers['Retry-After']))
+            except ValueError:
+                pass
+        return delay
+
+    async def _request(self, method, path, body=None, base_url=None):
+        session = self._get_session()
+        url = (base_url or self.API_URL) + path
+        error = None
+        for attempt in range(self.retries):
+            await self.bucket.acquire()
+            response = None
+            try:
+                async with self._semaphore:
+                    async with session.request(method, url, json=body) as response:
+                        # No content means the player dont exist
+                        if response.status in (204, 404):
+                            return None
+                        if response.status == 200:
+                            text = await response.text()
+                            return json.loads(text) if text else None
+                        error = f'HTTP {response.status}'
+                        # Other client errors wont change on retry
+                        if 400 <= response.status < 500 and response.status != 429:
+                            break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+            if attempt == self.retries - 1:
+                break
+            delay = self._retry_delay(response, attempt)
+            if response is not None and response.status == 429:
+                # Whole client waits, not only this request
+                self.bucket.pause(delay)
+            else:
+                await asyncio.sleep(delay)
+        raise MojangUnavailableError(error)
+
+    async def get_player(self, username):
+        if not is_valid_minecraft_username(username):
+            return PlayerData(valid=False)
+        json_data = await self._request("GET", "/users/profiles/minecraft/" + username)
+        if json_data is None:
+            return PlayerData(valid=False)
+        return PlayerData(UUID(json_data['id']), json_data['name'])
+
+    async def get_players(self, usernames):
+        result = {}
+        valid_names = []
+        for username in usernames:
+            key = username.lower()
+            if key in result:
+                continue
+            result[key] = PlayerData(valid=False)
+            if is_valid_minecraft_username(username):
+                valid_names.append(username)
+
+        chunks = [valid_names[i:i + BULK_LOOKUP_LIMIT] for i in range(0, len(valid_names), BULK_LOOKUP_LIMIT)]
+        responses = await asyncio.gather(*[self._request("POST", "/profiles/minecraft", chunk) for chunk in chunks])
+        for json_data in responses:
+            for profile in json_data or []:
+                result[profile['name'].lower()] = PlayerData(UUID(profile['id']), profile['name'])
+
+        return result
+
+    async def get_player_by_uuid(self, uuid):
+        json_data = await self._request("GET", "/session/minecraft/profile/" + uuid.hex, base_url=self.SESSION_URL)
+        if json_data is None:
+            return PlayerData(valid=False)
+        return PlayerData(UUID(json_data['id']), json_data['name'])
+
+    async def lookup_uuid(self, uuid):
+        """ Get current username of player, result is cached by that name """
+        player = self.cache.get_by_uuid(uuid) if self.cache is not None else None
+        if player is not None:
+            return player
+
+        key = 'uuid:' + uuid.hex
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+
+        self._register(key)
+        try:
+            player = await self.get_player_by_uuid(uuid)
+        except BaseException as e:
+            self._inflight.pop(key).set_exception(e)
+            raise
+        if player.valid and self.cache is not None:
+            self.cache.put(player.username, player)
+        self._inflight.pop(key).set_result(player)
+        return player
+
+    def _cached(self, username):
+        return self.cache.get(username) if self.cache is not None else None
+
+    def _register(self, key):
+        future = asyncio.get_event_loop().create_future()
+        # Failures without waiters are reported by the caller already
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+
+    def _resolve(self, keys, players=None, error=None):
+        for key in keys:
+            future = self._inflight.pop(key)
+            if error is not None:
+                future.set_exception(error)
+                continue
+            player = players[key]
+            if self.cache is not None:
+                self.cache.put(key, player)
+            future.set_result(player)
+
+    async def lookup(self, username):
+        player = self._cached(username)
+        if player is not None:
+            return player
+
+        key = username.lower()
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+
+        self._register(key)
+        try:
+            player = await self.get_player(username)
+        except BaseException as e:
+            self._resolve([key], error=e)
+            raise
+        self._resolve([key], {key: player})
+        return player
+
+    async def lookup_many(self, usernames):
+        result = {}
+        missing = []
+        waiting = []
+        for username in usernames:
+            key = username.lower()
+            if key in result:
+                continue
+            result[key] = self._cached(username)
+            if result[key] is not None:
+                continue
+            if key in self._inflight:
+                waiting.append((key, self._inflight[key]))
+            else:
+                self._register(key)
+                missing.append(username)
+
+        keys = [username.lower() for username in missing]
+        try:
+            players = await self.get_players(missing)
+        except BaseException as e:
+            self._resolve(keys, error=e)
+            raise
+        self._resolve(keys, players)
+        result.update(players)
+
+        for key, future in waiting:
+            result[key] = await asyncio.shield(future)
+
+        return result
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
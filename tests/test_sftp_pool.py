@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###################################################
+#........../\./\...___......|\.|..../...\.........#
+#........./..|..\/\.|.|_|._.|.\|....|.c.|.........#
+#......../....../--\|.|.|.|i|..|....\.../.........#
+#        Mathtin (c)                              #
+###################################################
+#   Author: Daniel [Mathtin] Shiko                #
+#   Copyright (c) 2020 <wdaniil@mail.ru>          #
+#   This file is released under the MIT license.  #
+###################################################
+
+"""
+SftpPool against local SFTP server stand-in
+
+In-process paramiko server serving temporary directory, pool connects to
+it with pysftp the same way ptero_sftp_connect does. Run from repository
+root:
+    python -m unittest discover tests
+"""
+
+__author__ = 'Mathtin'
+
+import importlib.machinery
+import importlib.util
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import paramiko
+import pysftp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Default settings if bot is not configured here
+try:
+    import config
+except ImportError:
+    loader = importlib.machinery.SourceFileLoader('config', os.path.join(ROOT, 'config.py.template'))
+    spec = importlib.util.spec_from_loader('config', loader)
+    config = importlib.util.module_from_spec(spec)
+    # Template imports util, which imports config back
+    sys.modules['config'] = config
+    spec.loader.exec_module(config)
+
+from util import SftpPool
+
+
+class StubServer(paramiko.ServerInterface):
+    """
+    Accepts any password, serves sftp subsystem only
+    """
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+    """
+    Flat file store in root directory, enough for uploads
+    """
+
+    root = None
+
+    def __path(self, path):
+        return os.path.join(self.root, os.path.basename(path))
+
+    def canonicalize(self, path):
+        return '/' + os.path.basename(path.rstrip('/.'))
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self.__path(path), flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = paramiko.SFTPHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, 'rb+' if flags & os.O_RDWR else ('wb' if flags & os.O_WRONLY else 'rb'))
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.__path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+
+class LocalSftp(object):
+    """
+    Listening socket, each connection gets own transport in thread
+    """
+
+    def __init__(self, root: str):
+        StubSFTPServer.root = root
+        self.key = paramiko.RSAKey.generate(1024)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        threading.Thread(target=self.__serve, daemon=True).start()
+
+    def __serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, StubSFTPServer)
+            transport.start_server(server=StubServer())
+            self.transports.append(transport)
+
+    def drop_all(self):
+        for transport in self.transports:
+            transport.close()
+
+    def close(self):
+        self.drop_all()
+        self.sock.close()
+
+    def connect(self, srv_id):
+        cnopts = pysftp.CnOpts()
+        cnopts.hostkeys = None
+        return pysftp.Connection('127.0.0.1', username=f'user.{srv_id}', password='x', cnopts=cnopts, port=self.port)
+
+
+class SftpPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.server = LocalSftp(self.dir.name)
+
+    def tearDown(self):
+        self.server.close()
+        self.dir.cleanup()
+
+    def read(self, name):
+        with open(os.path.join(self.dir.name, name), 'rb') as f:
+            return f.read()
+
+    def test_session_reused(self):
+        pool = SftpPool(self.server.connect)
+        try:
+            pool.upload('a', [(b'first', '/whitelist.json')])
+            pool.upload('a', [(b'ranks', '/ranks.txt'), (b'players', '/players.txt')])
+            self.assertEqual(pool.handshakes, 1)
+            self.assertEqual(self.read('whitelist.json'), b'first')
+            self.assertEqual(self.read('ranks.txt'), b'ranks')
+            self.assertEqual(self.read('players.txt'), b'players')
+        finally:
+            pool.close()
+
+    def test_reconnect_after_drop(self):
+        pool = SftpPool(self.server.connect)
+        try:
+            pool.upload('a', [(b'first', '/whitelist.json')])
+            self.server.drop_all()
+            time.sleep(0.1)
+            pool.upload('a', [(b'second', '/whitelist.json')])
+            self.assertEqual(pool.handshakes, 2)
+            self.assertEqual(self.read('whitelist.json'), b'second')
+        finally:
+            pool.close()
+
+    def test_idle_eviction(self):
+        pool = SftpPool(self.server.connect, idle_timeout=0.2)
+        try:
+            pool.upload('a', [(b'first', '/whitelist.json')])
+            self.assertIn('a', pool.sessions)
+            time.sleep(0.5)
+            self.assertNotIn('a', pool.sessions)
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###################################################
+#........../\./\...___......|\.|..../...\.........#
+#........./..|..\/\.|.|_|._.|.\|....|.c.|.........#
+#......../....../--\|.|.|.|i|..|....\.../.........#
+#        Mathtin (c)                              #
+###################################################
+#   Author: Daniel [Mathtin] Shiko                #
+#   Copyright (c) 2020 <wdaniil@mail.ru>          #
+#   This file is released under the MIT license.  #
+###################################################
+
+"""
+Measure memory held by dynamic profile rows with tracemalloc
+
+Compares former row layout (parsed dict keeping discord.Message and player
+object) against ProfileRecord. Messages are built offline from gateway-like
+payloads, no connection is made.
+
+Run from repository root with config.py in place:
+    PTERODACTYL_DOMAIN=localhost PTERODACTYL_TOKEN=x python tools/profile_memory.py [rows]
+"""
+
+__author__ = 'Mathtin'
+
+import os
+import sys
+import tracemalloc
+from types import SimpleNamespace
+from uuid import UUID
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # before manager, resolves import cycle
+import discord
+import manager
+from mcuuid import PlayerData
+
+
+class OfflineState(object):
+    """
+    Minimal connection state for building messages without client
+    """
+
+    def __init__(self):
+        self._users = {}
+        self.http = None
+
+    def store_user(self, data):
+        return discord.User(state=self, data=data)
+
+    def _get_guild(self, guild_id):
+        return None
+
+    def get_reaction_emoji(self, data):
+        return None
+
+
+state = OfflineState()
+guild = SimpleNamespace(id=1, get_member=lambda member_id: None, _state=state, me=None, roles=[])
+channel = discord.TextChannel.__new__(discord.TextChannel)
+channel.id = 99
+channel.guild = guild
+channel._state = state
+
+
+def make_message(i: int):
+    return discord.Message(state=state, channel=channel, data={
+        'id': str(10**17 + i), 'channel_id': '99', 'type': 0, 'tts': False, 'pinned': False,
+        'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [],
+        'timestamp': '2020-10-01T10:00:00+00:00', 'edited_timestamp': None,
+        'content': f'IGN: Player{i}\nAge: 20\nCountry: Somewhere far away\nAbout: ' + 'x' * 120,
+        'author': {'id': str(10**17 + 50000 + i), 'username': f'user{i}', 'discriminator': '0001', 'avatar': 'a' * 32}
+    })
+
+
+def make_dict_row(i: int):
+    message = make_message(i)
+    row = manager.parse_colon_seperated(message.content)
+    row['msg'] = message
+    row['player'] = PlayerData(UUID(int=i), f'Player{i}')
+    row['id'] = i
+    return row
+
+
+def make_record_row(i: int):
+    message = make_message(i)
+    row = manager.ProfileRecord.from_message(message, manager.parse_colon_seperated(message.content))
+    row.set_player(PlayerData(UUID(int=i), f'Player{i}'))
+    row.id = i
+    return row
+
+
+def measure(build, count: int):
+    """ Bytes still allocated after building count rows """
+    tracemalloc.start()
+    base = tracemalloc.take_snapshot()
+    rows = [build(i) for i in range(count)]
+    size = sum(s.size_diff for s in tracemalloc.take_snapshot().compare_to(base, 'filename'))
+    tracemalloc.stop()
+    del rows
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    for name, build in [('dict+Message', make_dict_row), ('ProfileRecord', make_record_row)]:
+        size = measure(build, count)
+        print(f'{name}: {size / 1024:.0f} KiB for {count} rows ({size / count:.0f} B/row)')
+
+
+if __name__ == '__main__':
+    main()
@@ -19,8 +19,14 @@ import config
 import asyncio
 import discord
 import pysftp
+import paramiko
 import shlex
 import os
+import io
+import threading
+import time
+
+log = logging.getLogger('util')
 
 #################
 # Utility Funcs #
@@ -93,7 +99,9 @@ def build_cmdcoro_usage(cmdname, func):
     f_args = func.__code__.co_varnames[:func.__code__.co_argcount]
     assert len(f_args) >= 2
     f_args = f_args[2:]
-    args_str = ' ' + ' '.join(["{%s}" % arg for arg in f_args])
+    # Arguments with default values are optional
+    required = len(f_args) - len(func.__defaults__ or ())
+    args_str = ' ' + ' '.join(["{%s}" % arg if i < required else "[%s]" % arg for i, arg in enumerate(f_args)])
     return f'{prefix}{cmdname}' + args_str
 
 def cmdcoro(func):
@@ -102,9 +110,10 @@ def cmdcoro(func):
     f_args = func.__code__.co_varnames[:func.__code__.co_argcount]
     assert len(f_args) >= 2
     f_args = f_args[2:]
+    required = len(f_args) - len(func.__defaults__ or ())
 
     async def wrapped_func(client, message, argv):
-        if len(f_args) != len(argv) - 1:
+        if not required <= len(argv) - 1 <= len(f_args):
             usage_str = 'Usage: ' + build_cmdcoro_usage(argv[0], func)
             await message.channel.send(usage_str)
         else:
@@ -114,14 +123,34 @@ def cmdcoro(func):
     
     return wrapped_func
 
-def ptero_sftp_upload(srv_id, src_path, dst_path):
+def ptero_sftp_connect(srv_id):
     username = f'{os.environ.get("PTERODACTYL_USERNAME")}.{srv_id}'
     password = os.environ.get("PTERODACTYL_PASSWORD")
     domain = os.environ.get("PTERODACTYL_DOMAIN")
+    port = config_path("sftp.port", 2022)
     cnopts = pysftp.CnOpts()
     cnopts.hostkeys = None
-    with pysftp.Connection(domain, username=username, password=password, cnopts=cnopts, port=2022) as sftp:
-        sftp.put(src_path, dst_path)
+    return pysftp.Connection(domain, username=username, password=password, cnopts=cnopts, port=port)
+
+def ptero_sftp_upload(srv_id, src, dst_path):
+    """ Upload local file path, bytes or file-like object """
+    sftp_pool().upload(srv_id, [(src, dst_path)])
+
+def ptero_sftp_upload_many(srv_id, files: list):
+    """ Upload (src, dst_path) pairs in one session """
+    sftp_pool().upload(srv_id, files)
+
+__sftp_pool = None
+def sftp_pool():
+    global __sftp_pool
+    if __sftp_pool is None:
+        __sftp_pool = SftpPool(
+            ptero_sftp_connect,
+            idle_timeout=config_path("sftp.idle_timeout", 300),
+            keepalive=config_path("sftp.keepalive", 30),
+            health_check=config_path("sftp.health_check", 60)
+        )
+    return __sftp_pool
 
 ###################
 # Utility Classes #
@@ -137,6 +166,150 @@ class NotCoroutineException(TypeError):
     def __init__(self, func):
         super().__init__(f'{str(func)} is not a coroutine function')
 
+class SftpPool(object):
+    """
+    SFTP sessions kept open per server id
+
+    connect(srv_id) makes new pysftp.Connection-like session. Sessions
+    idle for idle_timeout seconds are closed by background thread,
+    sessions idle for health_check seconds are checked before use. Transfer failing on
+    reused session is retried once on a fresh one. Safe to use from
+    worker threads, session of a server is used by one thread at a time.
+    """
+
+    def __init__(self, connect, idle_timeout: float = 300, keepalive: float = 30, health_check: float = 60):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.health_check = health_check
+        self.lock = threading.Lock()
+        # srv_id -> [session, last used time]
+        self.sessions = {}
+        self.server_locks = {}
+        self.handshakes = 0
+        self.evictor = None
+        self.stopped = None
+
+    def __server_lock(self, srv_id):
+        with self.lock:
+            if srv_id not in self.server_locks:
+                self.server_locks[srv_id] = threading.Lock()
+            return self.server_locks[srv_id]
+
+    def __open(self, srv_id):
+        session = self.connect(srv_id)
+        self.handshakes += 1
+        if self.keepalive:
+            try:
+                session.sftp_client.get_channel().get_transport().set_keepalive(self.keepalive)
+            except AttributeError:
+                pass
+        return session
+
+    def __close(self, session):
+        try:
+            session.close()
+        except Exception as e:
+            log.warn(f'Failed to close SFTP session: {e}')
+
+    def __is_alive(self, session):
+        try:
+            session.pwd
+            return True
+        except (OSError, EOFError, paramiko.SSHException):
+            return False
+
+    def __acquire(self, srv_id):
+        """ Reused session or None """
+        with self.lock:
+            entry = self.sessions.pop(srv_id, None)
+        if entry is None:
+            return None
+        session, last_used = entry
+        idle = time.monotonic() - last_used
+        if idle > self.idle_timeout or (idle > self.health_check and not self.__is_alive(session)):
+            self.__close(session)
+            return None
+        return session
+
+    def __release(self, srv_id, session):
+        with self.lock:
+            self.sessions[srv_id] = [session, time.monotonic()]
+            if self.evictor is None:
+                self.stopped = threading.Event()
+                self.evictor = threading.Thread(target=self.__evict_loop, args=(self.stopped,), name='sftp-evictor', daemon=True)
+                self.evictor.start()
+
+    def __evict_loop(self, stopped: threading.Event):
+        # Session is closed at most half of timeout late
+        while not stopped.wait(self.idle_timeout / 2):
+            self.evict_idle()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = [s for s, (_, last_used) in self.sessions.items() if now - last_used > self.idle_timeout]
+            evicted = [self.sessions.pop(srv_id)[0] for srv_id in idle]
+        for session in evicted:
+            self.__close(session)
+
+    def close(self):
+        with self.lock:
+            sessions = [session for session, _ in self.sessions.values()]
+            self.sessions = {}
+            if self.evictor is not None:
+                self.stopped.set()
+                self.evictor = None
+        for session in sessions:
+            self.__close(session)
+
+    def run(self, srv_id, func):
+        """ Call func(session) with pooled session of server """
+        self.evict_idle()
+        with self.__server_lock(srv_id):
+            session = self.__acquire(srv_id)
+            reused = session is not None
+            if not reused:
+                session = self.__open(srv_id)
+            try:
+                res = func(session)
+            except (OSError, EOFError, paramiko.SSHException) as e:
+                self.__close(session)
+                if not reused:
+                    raise
+                # Connection may have been dropped while idle
+                log.warn(f'SFTP session to [{srv_id}] failed ({e}), reconnecting')
+                session = self.__open(srv_id)
+                try:
+                    res = func(session)
+                except BaseException:
+                    self.__close(session)
+                    raise
+            except BaseException:
+                self.__close(session)
+                raise
+            self.__release(srv_id, session)
+            return res
+
+    def upload(self, srv_id, files: list):
+        """
+        Upload (src, dst_path) pairs in one session
+
+        src is local file path, bytes or file-like object, which is read
+        from its current position (again on retry).
+        """
+        starts = [src.tell() if hasattr(src, 'read') else None for src, _ in files]
+        def put_all(session):
+            for (src, dst_path), start in zip(files, starts):
+                if isinstance(src, (bytes, bytearray, memoryview)):
+                    session.putfo(io.BytesIO(src), dst_path)
+                elif hasattr(src, 'read'):
+                    src.seek(start)
+                    session.putfo(src, dst_path)
+                else:
+                    session.put(src, dst_path)
+        self.run(srv_id, put_all)
+
 class DiscordBotLogHandler(logging.Handler):
     
     instances = {}
@@ -167,8 +340,8 @@ class DiscordBotLogHandler(logging.Handler):
 # Bot model utility funcs #
 ###########################
 
-def is_admin_message(msg: discord.Message):
-    for role in msg.author.roles:
+def is_admin_user(user: discord.Member):
+    for role in user.roles:
         if role.name in config.roles["admin"]:
             return True
     return False
@@ -192,6 +365,3 @@ def is_text_channel(channel):
 
 def is_dm_message(message: discord.Message):
     return isinstance(message.channel, discord.DMChannel)
-
-def is_same_author(m1: discord.Message, m2: discord.Message):
-    return m1.author.id == m2.author.id